@@ -1,11 +1,12 @@
 import matplotlib.pyplot as plt                 # For normal plotting
 from mpl_toolkits.mplot3d import proj3d         # For 3D plotting
 import numpy as np                             # For maths
+import math                                     # For scalar trig
 from scipy import ndimage                       # For image rotations
+from scipy import fft as spfft                  # For multithreaded FFTs
 import RegTomoReconMulti as rtr                 # Modified version of Rob's CS code
-from scipy import optimize                      # For function minimization
 from PIL import Image
-import copy                                     # For deepcopy
+from functools import lru_cache                 # For caching k-space grids
 try:
     import astra
     from pyevtk.hl import gridToVTK
@@ -15,6 +16,26 @@ try:
 except:
     print('Astra/transforms/pyevtk import failed')
 
+try:
+    from numba import njit, prange, get_num_threads # For compiled loops
+    has_numba = True
+except:
+    print('Numba import failed')
+    has_numba = False
+    prange = range
+    def njit(*args,**kwargs):
+        """ Fallback so numba kernels still run, as (slow) plain python """
+        if len(args) == 1 and callable(args[0]):
+            return args[0]
+        return lambda f: f
+
+try:
+    import cupy as cp                           # For GPU arrays
+    from cupyx.scipy.ndimage import affine_transform as cu_affine
+    from cupyx.scipy import fft as cupyx_fft
+except:
+    cp = None
+
 from scipy import constants  
 import matplotlib.patches as patches
 import matplotlib
@@ -24,13 +45,22 @@ from libertem.utils.generate import hologram_frame
 from scipy.ndimage import zoom
 from skimage.restoration import unwrap_phase
 
-def generate_tri_pris(n = 100, size_n = 1,pi=1):
+def _grid(n,size_n):
+    """ Node positions xs spanning -n/2 to n/2 with int(n/size_n) nodes,
+    plus its (N,1,1), (1,N,1), (1,1,N) views to use as sparse X,Y,Z grids
+    (float64, as the sparse grids are small and the inside/outside tests then
+    break ties at shape edges exactly as the dense float64 meshgrids did) """
+    xs = np.linspace(-n/2,n/2,int(n/size_n))
+    return xs, xs.reshape(-1,1,1), xs.reshape(1,-1,1), xs.reshape(1,1,-1)
+
+def generate_tri_pris(n = 100, size_n = 1,pi=1,backend='numpy'):
     """ 
     Generate triangular prism data (with missing slice)
     
     Input:
     n = number of nodes in each dimension (nxnxn grid)
     size_n = length in nm of each node
+    backend = 'numpy' (broadcast masks) or 'numba' (single compiled pass)
     
     Output:
     X,Y,Z,MX,MY,MZ = Gridded coordinates, gridded magnetisation
@@ -41,74 +71,71 @@ def generate_tri_pris(n = 100, size_n = 1,pi=1):
     m2, c2 = 0, -25
     m3, c3 = -0.6, 0
     
-    # Generate x,y,z value
-    xs = np.linspace(-n/2,n/2,int(n/size_n))
-    ys = np.linspace(-n/2,n/2,int(n/size_n))
-    zs = np.linspace(-n/2,n/2,int(n/size_n))
-    
-    X,Y,Z = np.meshgrid(xs,ys,zs,indexing='ij')
+    # Generate x,y,z value and sparse (broadcastable) X,Y,Z grids
+    xs,X,Y,Z = _grid(n,size_n)
+    ys = zs = xs
 
-    # Assign density
-    data = []
-    for x in xs:
-        for y in ys:
-            for z in zs:
-                if y < (m1*x+c1) and y > (m2*x + c2) and y < (m3*x + c3) and ((z >-20 and z<-10) or (z>0 and z<40)):
-                    p = pi
-                    data.append([x,y,z,p])
-                else:
-                    p = 0
-                    data.append([x,y,z,p])
+    if backend == 'numba':
+        P = np.empty((len(xs),len(ys),len(zs)),dtype=np.float32)
+        lines = np.array([m1,c1,m2,c2,m3,c3],dtype=np.float64)
+        _tri_pris_kernel(xs,ys,zs,lines,np.float32(pi),P)
+        return X,Y,Z,P
 
-    # Extract density
-    P = np.take(data,3,axis=1)
+    # Assign density
+    mask = (Y < m1*X+c1) & (Y > m2*X+c2) & (Y < m3*X+c3) & \
+           (((Z > -20) & (Z < -10)) | ((Z > 0) & (Z < 40)))
+    P = (mask*pi).astype(np.float32)
 
-    P = P.reshape(len(xs),len(ys),len(zs))
-    
     return X,Y,Z,P
 
+@njit(parallel=True,cache=True)
+def _tri_pris_kernel(xs,ys,zs,lines,pi,out):
+    """ Fill out with the generate_tri_pris density, where lines holds
+    the gradient/intercept pairs (m1,c1,m2,c2,m3,c3) """
+    m1, c1, m2, c2, m3, c3 = lines[0], lines[1], lines[2], lines[3], lines[4], lines[5]
+    for i in prange(xs.shape[0]):
+        x = xs[i]
+        for j in range(ys.shape[0]):
+            y = ys[j]
+            inside = (y < m1*x+c1) and (y > m2*x+c2) and (y < m3*x+c3)
+            for k in range(zs.shape[0]):
+                z = zs[k]
+                if inside and ((z > -20 and z < -10) or (z > 0 and z < 40)):
+                    out[i,j,k] = pi
+                else:
+                    out[i,j,k] = 0
+
 def generate_sphere(n = 100, size_n = 1,pi=1,c=(0,0,0),r=30):
     """ Generate sphere of radius r centred at c
     """
-    # Generate x,y,z value
-    xs = np.linspace(-n/2,n/2,int(n/size_n))
-    ys = np.linspace(-n/2,n/2,int(n/size_n))
-    zs = np.linspace(-n/2,n/2,int(n/size_n))
-    X,Y,Z = np.meshgrid(xs,ys,zs,indexing='ij')
+    # Generate x,y,z value and sparse (broadcastable) X,Y,Z grids
+    xs,X,Y,Z = _grid(n,size_n)
 
 #     c = (0,0,0)
 #     r = 30
-    
-    # Assign density to sphere
-    data = []
-    for x in xs:
-        for y in ys:
-            for z in zs:
-                if (x-c[0])**2 + (y-c[1])**2 + (z-c[2])**2 < r**2:
-                    p = 1
-                    data.append([x,y,z,p])
 
-                else:
-                    p = 0
-                    data.append([x,y,z,p])
+    # Distance of each axis from the centre, broadcastable to (nx,ny,nz)
+    xb = X-c[0]
+    yb = Y-c[1]
+    zb = Z-c[2]
 
-    # Extract density
-    P = np.take(data,3,axis=1)
+    # Assign density to sphere
+    P = ((xb*xb + yb*yb + zb*zb) < r*r).astype(np.float32)
 
-    P = P.reshape(len(xs),len(ys),len(zs))
-    
     return X,Y,Z,P
 
-def generate_tetrapod(n = 100, size_n = 1,pi=1, r_tet=40,r_cyl = 10):
+def generate_tetrapod(n = 100, size_n = 1,pi=1, r_tet=40,r_cyl = 10,backend='numpy'):
     """ Generate a tetrapod centred at (0,0,0), A-D labelled vertices,
     starting at top and going c/w. AOB is in the xz plane.
-    Length of each leg is r_tet and radius of each leg is r_cyl """
+    Length of each leg is r_tet and radius of each leg is r_cyl
+    
+    backend = 'numpy' builds one leg and rotates it to get the others,
+              'numba' tests all four legs analytically in a compiled loop
+              (sharp edges, no interpolation from the rotations) """
 
-    # Generate x,y,z value
-    xs = np.linspace(-n/2,n/2,int(n/size_n))
-    ys = np.linspace(-n/2,n/2,int(n/size_n))
-    zs = np.linspace(-n/2,n/2,int(n/size_n))
-    X,Y,Z = np.meshgrid(xs,ys,zs,indexing='ij')
+    # Generate x,y,z value and sparse (broadcastable) X,Y,Z grids
+    xs,X,Y,Z = _grid(n,size_n)
+    ys = zs = xs
 
     # Tetrahedron with O at centre, A-D labelled vertices starting at top and going c/w. AOB is in the xz plane.
     r_tet = r_tet # length of each leg of the tetrapod (i.e. length of OA, OB, OC, OD)
@@ -126,21 +153,24 @@ def generate_tetrapod(n = 100, size_n = 1,pi=1, r_tet=40,r_cyl = 10):
     # Cylinder from centre to top vertex of the tetrahedron
     r_cyl = r_cyl
 
-    # Assign density to first cylinder
-    data = []
-    for x in xs:
-        for y in ys:
-            for z in zs:
-                if (x-c[0])**2 + (y-c[1])**2 < r_cyl**2 and ((z >c[2] and z<(c[2]+r_tet))):
-                    p = pi
-                    data.append([x,y,z,p])
-                else:
-                    p = 0
-                    data.append([x,y,z,p])
+    if backend == 'numba':
+        # Leg directions, matching the rotations applied below
+        uA = np.array([0,0,1])
+        uB = rotation_matrix(0,120,0).dot(uA)
+        uC = rotation_matrix(0,0,120).dot(uB)
+        uD = rotation_matrix(0,0,-120).dot(uB)
+        legs = np.array([uA,uB,uC,uD],dtype=np.float32)
+
+        tetrapod = np.empty((len(xs),len(ys),len(zs)),dtype=np.float32)
+        _tetrapod_kernel(xs,ys,zs,legs,r_tet,r_cyl,pi,tetrapod)
 
-    # Extract density
-    P = np.take(data,3,axis=1)
-    P = P.reshape(len(xs),len(ys),len(zs))
+        return X,Y,Z,tetrapod
+
+    # Assign density to first cylinder
+    xb = X-c[0]
+    yb = Y-c[1]
+    mask = (xb*xb + yb*yb < r_cyl**2) & (Z > c[2]) & (Z < c[2]+r_tet)
+    P = (mask*pi).astype(np.float32)
 
     # Rotate cylinder to get other legs
     OA = rotate_bulk(P,0,0,0)
@@ -153,15 +183,31 @@ def generate_tetrapod(n = 100, size_n = 1,pi=1, r_tet=40,r_cyl = 10):
     
     return X,Y,Z,tetrapod
 
-def generate_pillar_cavities(n = 100, size_n = 1,pi=1,x_len=70,y_len=50,z_len=50,r_cyl=15,depth=25,nx=1,ny=1,cavity_val=0):
+@njit(parallel=True,cache=True)
+def _tetrapod_kernel(xs,ys,zs,legs,r_tet,r_cyl,pi,out):
+    """ Set out to pi wherever (x,y,z) lies within r_cyl of any leg,
+    where legs are unit vectors from the origin of length r_tet """
+    for i in prange(xs.shape[0]):
+        for j in range(ys.shape[0]):
+            for k in range(zs.shape[0]):
+                x, y, z = xs[i], ys[j], zs[k]
+                r2 = x*x + y*y + z*z
+                p = 0
+                for l in range(legs.shape[0]):
+                    # distance along the leg and squared distance from it
+                    t = x*legs[l,0] + y*legs[l,1] + z*legs[l,2]
+                    if 0 < t < r_tet and r2 - t*t < r_cyl*r_cyl:
+                        p = pi
+                out[i,j,k] = p
+
+def generate_pillar_cavities(n = 100, size_n = 1,pi=1,x_len=70,y_len=50,z_len=50,r_cyl=15,depth=25,nx=1,ny=1,cavity_val=0,backend='numpy'):
     """ Generate box of dimensions (x_len,y_len,z_len) with hollow pillars of 'depth' length
         etched into the top z face. There will be an array of nx x ny pillars, each of radius r_cyl.
+        backend = 'numpy' (broadcast masks) or 'numba' (single compiled pass)
     """
-    # Generate x,y,z value
-    xs = np.linspace(-n/2,n/2,int(n/size_n))
-    ys = np.linspace(-n/2,n/2,int(n/size_n))
-    zs = np.linspace(-n/2,n/2,int(n/size_n))
-    X,Y,Z = np.meshgrid(xs,ys,zs,indexing='ij')
+    # Generate x,y,z value and sparse (broadcastable) X,Y,Z grids
+    xs,X,Y,Z = _grid(n,size_n)
+    ys = zs = xs
 
     # Box dimensions
 #     x_len = 70
@@ -182,63 +228,75 @@ def generate_pillar_cavities(n = 100, size_n = 1,pi=1,x_len=70,y_len=50,z_len=50
         for cy in cys:
             cs.append((cx,cy))
 
-    # Assign density to box
-    data = []
-    for x in xs:
-        for y in ys:
-            for z in zs:
-                if -x_len/2 < x < x_len/2 and -y_len/2 < y < y_len/2 and -z_len/2 < z < z_len/2:
-                    p = 1
-
-                    for c in cs:
-                        if (x-c[0])**2 + (y-c[1])**2 < r_cyl**2 and z > z_len/2-depth:
-                            p = cavity_val
+    if backend == 'numba':
+        P = np.empty((len(xs),len(ys),len(zs)),dtype=np.float32)
+        centres = np.array(cs,dtype=np.float64).reshape(-1,2)
+        dims = np.array([x_len/2,y_len/2,z_len/2,r_cyl**2,z_len/2-depth],dtype=np.float64)
+        _pillar_cavities_kernel(xs,ys,zs,centres,dims,np.float32(cavity_val),P)
+        return X,Y,Z,P
 
-                    data.append([x,y,z,p])
+    # Assign density to box
+    box = (np.abs(X) < x_len/2) & (np.abs(Y) < y_len/2) & (np.abs(Z) < z_len/2)
 
-                else:
-                    p = 0
-                    data.append([x,y,z,p])
+    # Test every voxel column against all K cavity centres at once (nx,ny,1,K)
+    cxa = np.array([c[0] for c in cs]).reshape(1,1,1,-1)
+    cya = np.array([c[1] for c in cs]).reshape(1,1,1,-1)
+    in_cyl = (((X[...,None]-cxa)**2 + (Y[...,None]-cya)**2) < r_cyl**2).any(axis=-1)
+    cav = in_cyl & (Z > z_len/2-depth)
 
-    # Extract density
-    P = np.take(data,3,axis=1)
+    P = np.where(box, np.where(cav, cavity_val, 1), 0).astype(np.float32)
 
-    P = P.reshape(len(xs),len(ys),len(zs))
-    
     return X,Y,Z,P
 
+@njit(parallel=True,cache=True)
+def _pillar_cavities_kernel(xs,ys,zs,centres,dims,cavity_val,out):
+    """ Fill out with the generate_pillar_cavities density, where dims holds
+    (x_len/2, y_len/2, z_len/2, r_cyl**2, z_len/2-depth) """
+    for i in prange(xs.shape[0]):
+        x = xs[i]
+        for j in range(ys.shape[0]):
+            y = ys[j]
+            # Is this column inside any of the cavity cylinders?
+            in_cyl = False
+            for c in range(centres.shape[0]):
+                dx = x-centres[c,0]
+                dy = y-centres[c,1]
+                if dx*dx + dy*dy < dims[3]:
+                    in_cyl = True
+            in_xy = abs(x) < dims[0] and abs(y) < dims[1]
+            for k in range(zs.shape[0]):
+                z = zs[k]
+                if in_xy and abs(z) < dims[2]:
+                    if in_cyl and z > dims[4]:
+                        out[i,j,k] = cavity_val
+                    else:
+                        out[i,j,k] = 1
+                else:
+                    out[i,j,k] = 0
+
 def generate_layered_rod(n = 100, size_n = 1,pi=1,r=25,length=80,disc_width = 10):
     """ Generate cylindrical rod of length 80, with alternating discs every 'disc_width'
     Rod is aligned along z
     """
-    # Generate x,y,z value
-    xs = np.linspace(-n/2,n/2,int(n/size_n))
-    ys = np.linspace(-n/2,n/2,int(n/size_n))
-    zs = np.linspace(-n/2,n/2,int(n/size_n))
-    X,Y,Z = np.meshgrid(xs,ys,zs,indexing='ij')
+    # Generate x,y,z value and sparse (broadcastable) X,Y,Z grids
+    xs,X,Y,Z = _grid(n,size_n)
 
     c = (0,0,0)
 
-    # Assign density to rod
-    data = []
-    for x in xs:
-        for y in ys:
-            for z in zs:
-                if (y-c[1])**2 + (x-c[0])**2 < r**2 and -length/2 < z < length/2 :
-                    p = 1
-                    if np.floor(abs(-length/2-z)/disc_width)%2 == 0:
-                        p = .25
-                        
-                    data.append([x,y,z,p])
-                else:
-                    p = 0
-                    data.append([x,y,z,p])
+    # Offsets from the rod axis, broadcastable to (nx,ny,nz)
+    xb = X-c[0]
+    yb = Y-c[1]
 
-    # Extract density
-    P = np.take(data,3,axis=1)
+    # Cylinder of radius r and its extent along z
+    cyl = (xb*xb + yb*yb) < r*r
+    axial = (Z > -length/2) & (Z < length/2)
+
+    # Every other disc of width disc_width (starting at the base) is less dense
+    stripe = np.floor(np.abs(-length/2-Z)/disc_width) % 2 == 0
+
+    # Assign density to rod
+    P = np.where(cyl & axial, np.where(stripe, .25, 1), 0).astype(np.float32)
 
-    P = P.reshape(len(xs),len(ys),len(zs))
-    
     return X,Y,Z,P
 
 def plot_2d(X,Y,Z,P,s=5,size=0.1, width = 0.005, title='',ax=None,fig=None):
@@ -257,10 +315,7 @@ def plot_2d(X,Y,Z,P,s=5,size=0.1, width = 0.005, title='',ax=None,fig=None):
     - Arrows show direction of M
     - Background color shows magnitude of M
     """
-    # Project along z by averaging
-    x_proj = np.mean(X,axis=2)
-    y_proj = np.mean(Y,axis=2)
-    z_proj = np.mean(Z,axis=2)
+    # Project along z by averaging (X,Y,Z may be sparse grids, only their range is needed)
     p_proj = np.mean(P,axis=2)
     
     if ax == None:
@@ -269,7 +324,7 @@ def plot_2d(X,Y,Z,P,s=5,size=0.1, width = 0.005, title='',ax=None,fig=None):
 
     # Plot magnitude
     im1 = ax.imshow(np.flipud(p_proj.T),vmin=0,vmax=1,cmap='Blues',
-                     extent=(np.min(x_proj),np.max(x_proj),np.min(y_proj),np.max(y_proj)))
+                     extent=(np.min(X),np.max(X),np.min(Y),np.max(Y)))
     
     # Add colorbar and labels
     clb = fig.colorbar(im1,ax=ax,fraction=0.046, pad=0.04)
@@ -287,7 +342,8 @@ def rotate_bulk(P,ax,ay,az,mode='ndimage'):
     Rotate magnetisation locations from rotation angles ax,ay,az 
     about the x,y,z axes (given in degrees) 
     
-    Can use PIL or ndimage. ndimage def works but PIL faster (should work! currently doesn't handle -ve)
+    Can use PIL, ndimage or cupy. ndimage def works but PIL faster (should work! currently doesn't handle -ve)
+    cupy resamples on the GPU and returns a cupy array (P may already be on the GPU)
     
     NOTE: This implementation of scipy rotations is EXTRINSIC
     Therefore, to make it compatible with our intrinsic vector
@@ -314,15 +370,57 @@ def rotate_bulk(P,ax,ay,az,mode='ndimage'):
             
         return Prot
     
-    else:
-        ay = -ay
+    R, offset = rotate_bulk_affine(np.shape(P),ax,ay,az)
+    P = P.astype(np.float32,copy=False)
+
+    if mode == 'cupy':
+        P_gpu = cp.asarray(P)
+        out_gpu = cp.empty_like(P_gpu)
+        cu_affine(P_gpu,cp.asarray(R),offset=cp.asarray(offset),order=1,
+                  mode='constant',cval=0.0,output=out_gpu)
 
-        P = ndimage.rotate(P,ax,reshape=False,axes=(1,2),order=1)
-        P = ndimage.rotate(P,ay,reshape=False,axes=(2,0),order=1)
-        P = ndimage.rotate(P,az,reshape=False,axes=(0,1),order=1)
+        return out_gpu
+
+    else:
+        P = ndimage.affine_transform(P,R,offset=offset,order=1,mode='constant',cval=0.0)
 
         return P
 
+def rotate_bulk_affine(shape,ax,ay,az):
+    """ Matrix and offset for resampling a volume of given shape in rotate_bulk
+    
+    The three ndimage rotations (x, then -y, then z, about the array
+    centre) compose to the transpose of the intrinsic rotation matrix,
+    so resample once rather than three times.
+    Cached by shape and angles (e.g. AX, AY, AZ at each angle of a tilt
+    series), so the arrays returned are read-only """
+    return _rotate_bulk_affine(tuple(shape),float(ax),float(ay),float(az))
+
+@lru_cache(maxsize=1024)
+def _rotate_bulk_affine(shape,ax,ay,az):
+    # snap round-off (cos 90 = 6e-17) so right-angle rotations land exactly on the grid
+    # rather than just outside it, where mode='constant' would zero an edge plane
+    R = np.round(rotation_matrix(ax,ay,az,intrinsic=True).T,12)
+    centre = (np.array(shape)-1)/2
+    offset = np.round(centre - R.dot(centre),9)
+    
+    for a in (R,offset):
+        a.flags.writeable = False
+    return R, offset
+
+def rotate_slice(P,ax,ay,az,axis,idx):
+    """ Single 2D slice (index idx along axis) of rotate_bulk(P,ax,ay,az),
+    resampling only that plane rather than the whole volume """
+    R, offset = rotate_bulk_affine(np.shape(P),ax,ay,az)
+    offset = offset + R[:,axis]*idx
+    out_shape = list(np.shape(P))
+    out_shape[axis] = 1
+    
+    Pslice = ndimage.affine_transform(P.astype(np.float32,copy=False),R,offset=offset,
+                                      output_shape=tuple(out_shape),order=1,mode='constant',cval=0.0)
+    
+    return Pslice.squeeze(axis)
+
 def plot_plane(P,ax,v=[0,0,1]):
     x,y,z = v
     y = -y
@@ -396,28 +494,38 @@ def rotation_matrix(ax,ay,az,intrinsic=True):
     (Uses convention of rotating about z, then y, then x)
     """
 
-    ax = ax * np.pi/180
-    Cx = np.cos(ax)
-    Sx = np.sin(ax)
-    mrotx = np.array([[1,0,0],[0,Cx,-Sx],[0,Sx,Cx]])
-    
-    ay = ay * np.pi/180
-    Cy = np.cos(ay)
-    Sy = np.sin(ay)
-    mroty = np.array([[Cy,0,Sy],[0,1,0],[-Sy,0,Cy]])
-    
-    az = az * np.pi/180
-    Cz = np.cos(az)
-    Sz = np.sin(az)
-    mrotz = np.array([[Cz,-Sz,0],[Sz,Cz,0],[0,0,1]])
+    # Scalar trig via math avoids numpy ufunc overhead on single angles
+    ax, ay, az = math.radians(ax), math.radians(ay), math.radians(az)
+    mrot = np.array(_rotation_entries(math.cos(ax),math.sin(ax),math.cos(ay),math.sin(ay),
+                                      math.cos(az),math.sin(az),intrinsic))
     
+    return mrot
+
+def _rotation_entries(Cx,Sx,Cy,Sy,Cz,Sz,intrinsic=True):
+    """ Nested list of the entries of the composed rotation matrix,
+    written out in full so no intermediate matrices are multiplied """
     if intrinsic == True:
-        mrot = mrotz.dot(mroty).dot(mrotx)
+        # Rz.Ry.Rx
+        return [[Cz*Cy, Cz*Sy*Sx - Sz*Cx, Cz*Sy*Cx + Sz*Sx],
+                [Sz*Cy, Sz*Sy*Sx + Cz*Cx, Sz*Sy*Cx - Cz*Sx],
+                [-Sy,   Cy*Sx,            Cy*Cx]]
     else:
         # To define mrot in an extrinsic space, matching
         # our desire for intrinsic rotation, we need
-        # to swap the order of the applied rotations
-        mrot = mrotx.dot(mroty).dot(mrotz)
+        # to swap the order of the applied rotations (Rx.Ry.Rz)
+        return [[Cy*Cz,                 -Cy*Sz,                 Sy],
+                [Sx*Sy*Cz + Cx*Sz, -Sx*Sy*Sz + Cx*Cz, -Sx*Cy],
+                [-Cx*Sy*Cz + Sx*Sz, Cx*Sy*Sz + Sx*Cz,  Cx*Cy]]
+
+def rotation_matrices(angles,intrinsic=True):
+    """ Batched rotation_matrix: returns an (N,3,3) stack of rotation
+    matrices for an (N,3) list of [ax,ay,az] angles in degrees """
+    a = np.deg2rad(np.asarray(angles,dtype=np.float64)).reshape(-1,3)
+    C, S = np.cos(a).T, np.sin(a).T
+    
+    # (3,3,N) entries, moved to (N,3,3)
+    mrot = np.array(_rotation_entries(C[0],S[0],C[1],S[1],C[2],S[2],intrinsic))
+    mrot = np.ascontiguousarray(mrot.transpose(2,0,1))
     
     return mrot
 
@@ -443,7 +551,7 @@ def get_astravec(ax,ay,az):
     return np.concatenate((r,d,u,v))
 
 def generate_angles(mode='x',n_tilt = 40, alpha=70,beta=40,gamma=180,dist_n2=8,tilt2='gamma'):
-    """ Return a list of [ax,ay,az] lists, each corresponding to axial
+    """ Return an (N,3) array of [ax,ay,az] rows, each corresponding to axial
     rotations applied to [0,0,1] to get a new projection direction.
     
     Modes = x, y, dual, quad, sync, dist, rand
@@ -456,191 +564,173 @@ def generate_angles(mode='x',n_tilt = 40, alpha=70,beta=40,gamma=180,dist_n2=8,t
     
     Specify if the 2nd tilt axis is beta or gamma """
     
-    angles = []
-    ax,ay,az = 0,0,0
+    def series(ax,ay,az):
+        """ Rows of [ax,ay,az], broadcasting any scalar angles """
+        return np.stack(np.broadcast_arrays(ax,ay,az),axis=-1).reshape(-1,3)
+    
+    angles = [np.zeros((0,3))]
     
     # x series
     if mode=='x':
-        for ax in np.linspace(-alpha,alpha,n_tilt):
-            angles.append([ax,ay,az])
+        angles.append(series(np.linspace(-alpha,alpha,n_tilt),0,0))
             
     if mode=='y':
         if tilt2 == 'beta':
-            for ay in np.linspace(-beta,beta,n_tilt):
-                angles.append([ax,ay,az])
+            angles.append(series(0,np.linspace(-beta,beta,n_tilt),0))
         if tilt2 == 'gamma':
-            if gamma >= 90:
-                az = 90
-            else:
-                az = gamma
-            for ax in np.linspace(-alpha,alpha,n_tilt):
-                angles.append([ax,ay,az])
+            az = min(gamma,90)
+            angles.append(series(np.linspace(-alpha,alpha,n_tilt),0,az))
             
     if mode=='dual':
-        for ax in np.linspace(-alpha,alpha,int(n_tilt/2)):
-            angles.append([ax,ay,az])
-            
-        ax,ay,az = 0,0,0
+        n = int(n_tilt/2)
+        angles.append(series(np.linspace(-alpha,alpha,n),0,0))
         if tilt2 == 'beta':
-            for ay in np.linspace(-beta,beta,int(n_tilt/2)):
-                angles.append([ax,ay,az])
+            angles.append(series(0,np.linspace(-beta,beta,n),0))
         if tilt2 == 'gamma':
-            if gamma >=90:
-                az = 90
-            else:
-                az = gamma
-            for ax in np.linspace(-alpha,alpha,int(n_tilt/2)):
-                angles.append([ax,ay,az])
+            az = min(gamma,90)
+            angles.append(series(np.linspace(-alpha,alpha,n),0,az))
     
     if mode=='quad':
+        n = int(n_tilt/4)
+        axs = np.linspace(-alpha,alpha,n)
         if tilt2 == 'beta':
-            for ax in np.linspace(-alpha,alpha,int(n_tilt/4)):
-                angles.append([ax,ay,az])
-            ax,ay,az = 0,0,0
-            for ay in np.linspace(-beta,beta,int(n_tilt/4)):
-                angles.append([ax,ay,az])
-            ay = beta
-            for ax in np.linspace(-alpha,alpha,int(n_tilt/4)):
-                angles.append([ax,ay,az])
-            ay = -beta
-            for ax in np.linspace(-alpha,alpha,int(n_tilt/4)):
-                angles.append([ax,ay,az])
+            angles.append(series(axs,0,0))
+            angles.append(series(0,np.linspace(-beta,beta,n),0))
+            angles.append(series(axs,beta,0))
+            angles.append(series(axs,-beta,0))
                     
         if tilt2 == 'gamma':
             if gamma >= 90:
-                for ax in np.linspace(-alpha,alpha,int(n_tilt/4)):
-                    angles.append([ax,ay,az])
-                az = 90
-                for ax in np.linspace(-alpha,alpha,int(n_tilt/4)):
-                    angles.append([ax,ay,az])
-                az = 45
-                for ax in np.linspace(-alpha,alpha,int(n_tilt/4)):
-                    angles.append([ax,ay,az])
-                az = -45
-                for ax in np.linspace(-alpha,alpha,int(n_tilt/4)):
-                        angles.append([ax,ay,az])           
+                azs = [0,90,45,-45]
             else:
-                az = gamma
-                for ax in np.linspace(-alpha,alpha,n_tilt/4):
-                    angles.append([ax,ay,az])
-                az = -gamma
-                for ax in np.linspace(-alpha,alpha,n_tilt/4):
-                    angles.append([ax,ay,az])
-                az = gamma/3
-                for ax in np.linspace(-alpha,alpha,n_tilt/4):
-                    angles.append([ax,ay,az])
-                az = -gamma/3
-                for ax in np.linspace(-alpha,alpha,n_tilt/4):
-                    angles.append([ax,ay,az])
+                azs = [gamma,-gamma,gamma/3,-gamma/3]
+            for az in azs:
+                angles.append(series(axs,0,az))
 
     # random series # g or b
     if mode=='rand':
-        for i in range(n_tilt):
-            ax_rand = np.random.rand()*alpha*2 - alpha
-            if tilt2 == 'beta':
-                ay_rand = np.random.rand()*beta*2 - beta
-                angles.append([ax_rand,ay_rand,0])
-            if tilt2 == 'gamma':
-                az_rand = np.random.rand()*gamma*2 - gamma
-                angles.append([ax_rand,0,az_rand])
+        ax_rand = np.random.uniform(-alpha,alpha,n_tilt)
+        if tilt2 == 'beta':
+            angles.append(series(ax_rand,np.random.uniform(-beta,beta,n_tilt),0))
+        if tilt2 == 'gamma':
+            angles.append(series(ax_rand,0,np.random.uniform(-gamma,gamma,n_tilt)))
             
     # alpha propto beta series # g or b
     if mode=='sync':
+        ax = np.linspace(-alpha,alpha,int(n_tilt/2))
         if tilt2 == 'beta': 
-            ax = np.linspace(-alpha,alpha,int(n_tilt/2))
             ay = np.linspace(-beta,beta,int(n_tilt/2))
-
-            for i,a in enumerate(ax):
-                angles.append([a,ay[i],0])
-
-            for i,a in enumerate(ax):
-                angles.append([a,-ay[i],0])
+            angles.append(series(ax,ay,0))
+            angles.append(series(ax,-ay,0))
         if tilt2 == 'gamma': 
-            ax = np.linspace(-alpha,alpha,int(n_tilt/2))
             az = np.linspace(-gamma,gamma,int(n_tilt/2))
-
-            for i,a in enumerate(ax):
-                angles.append([a,0,az[i]])
-
-            for i,a in enumerate(ax):
-                angles.append([a,0,-az[i]])
+            angles.append(series(ax,0,az))
+            angles.append(series(ax,0,-az))
                 
         # alpha propto beta series # g or b
     if mode=='sx':
+        ax = np.linspace(-alpha,alpha,int(n_tilt))
         if tilt2 == 'beta': 
-            ax = np.linspace(-alpha,alpha,int(n_tilt))
-            ay = np.linspace(-beta,beta,int(n_tilt))
-
-            for i,a in enumerate(ax):
-                angles.append([a,ay[i],0])
-
+            angles.append(series(ax,np.linspace(-beta,beta,int(n_tilt)),0))
         if tilt2 == 'gamma': 
-            ax = np.linspace(-alpha,alpha,int(n_tilt))
-            az = np.linspace(-gamma,gamma,int(n_tilt))
-
-            for i,a in enumerate(ax):
-                angles.append([a,0,az[i]])
-
-            # for i,a in enumerate(ax):
-            #     angles.append([a,0,-az[i]])
+            angles.append(series(ax,0,np.linspace(-gamma,gamma,int(n_tilt))))
             
     # even spacing # g or b
     if mode=='dist':
         ax = np.linspace(-alpha,alpha,int(n_tilt/dist_n2))
         if alpha == 90:
-            ax = np.linspace(-90,90,n_tilt/dist_n2+1)
+            ax = np.linspace(-90,90,int(n_tilt/dist_n2)+1)
             ax = ax[::-1]
+        # Each alpha is paired with every tilt2 value (alpha in outer loop)
         if tilt2 == 'beta': 
             ay = np.linspace(-beta,beta,dist_n2)
-            for x in ax:
-                for y in ay:
-                    angles.append([x,y,0])
+            angles.append(series(ax[:,None],ay[None,:],0))
         if tilt2 == 'gamma': 
             if gamma < 90:
                 az = np.linspace(-gamma,gamma,dist_n2)
-                for x in ax:
-                    for z in az:
-                        angles.append([x,0,z])
             if gamma >= 90:
-                az = np.linspace(-90,90,dist_n2+1)
-                for x in ax:
-                    for z in az[:-1]:
-                        angles.append([x,0,z])
+                az = np.linspace(-90,90,dist_n2+1)[:-1]
+            angles.append(series(ax[:,None],0,az[None,:]))
+    
+    angles = np.ascontiguousarray(np.concatenate(angles),dtype=np.float64)
     
     return angles
 
-def generate_proj_data(P,angles,normalise=True):
+def generate_proj_data(P,angles,normalise=True,mode='ndimage'):
     """ Returns projection dataset given phantom P
     and 3D projection angles list.
     
     Output is normalised and reshaped such that the
     projection slice dimension is in the middle, so as
-    to be compatible with astra."""
-    P_projs = []
+    to be compatible with astra.
     
-    for i in range(len(angles)):
-        ax,ay,az = angles[i]
-        P_rot = rotate_bulk(P,ax,ay,az) 
-        P_rot_proj =np.flipud(np.sum(P_rot,axis=2).T) #flip/T match data shape to expectations
-        P_projs.append(P_rot_proj) 
+    mode = 'cupy' keeps P on the GPU and only transfers each 2D projection back
+    mode = 'astra' forward projects all angles in a single astra GPU call"""
+    nx,ny,nz = np.shape(P)
+    
+    if mode == 'astra':
+        raw_data = astra_forward_project(P,angles)
+    
+    else:
+        # Projections written straight into astra's layout (proj is middle column)
+        raw_data = np.empty((ny,len(angles),nx),dtype=np.float32)
+    
+        if mode == 'cupy':
+            # Copy phantom to the GPU once, reuse one output buffer for every angle
+            P_gpu = cp.asarray(P)
+            out_gpu = cp.empty_like(P_gpu)
+    
+        for i in range(len(angles)):
+            ax,ay,az = angles[i]
+            # flipud(sum.T) matches data shape to expectations, so write the
+            # sum into a flipped, transposed view of this angle's slot
+            proj_view = raw_data[::-1,i,:].T
+            if mode == 'cupy':
+                R, offset = rotate_bulk_affine(P.shape,ax,ay,az)
+                cu_affine(P_gpu,cp.asarray(R),offset=cp.asarray(offset),order=1,
+                          mode='constant',cval=0.0,output=out_gpu)
+                proj_view[...] = cp.asnumpy(cp.sum(out_gpu,axis=2))
+            else:
+                P_rot = rotate_bulk(P,ax,ay,az) 
+                np.add.reduce(P_rot,axis=2,out=proj_view)
         
-    # Prepare projections for reconstruction
-    raw_data = np.array(P_projs)
+    # Prepare projections for reconstruction (in place, raw_data is ours)
     if normalise == True:
-        raw_data = raw_data -  raw_data.min()
-        raw_data = raw_data/raw_data.max()
-    raw_data = np.transpose(raw_data,axes=[1,0,2]) # reshape so proj is middle column
+        raw_data -= raw_data.min()
+        raw_data /= raw_data.max()
         
     return raw_data
       
+def astra_forward_project(P,angles):
+    """ Forward project phantom P at every angle with astra's GPU projector,
+    returning the sinogram in the same (ny, n_angles, nx) layout as generate_proj_data """
+    nx,ny,nz = np.shape(P)
+    
+    # Orient phantom as an astra (slices,rows,cols) volume, i.e. the inverse of reorient_reconstruction
+    vol = np.ascontiguousarray(np.transpose(P,[2,1,0])[:,::-1,:],dtype=np.float32)
+    
+    proj_geom = astra.create_proj_geom('parallel3d_vec',ny,nx,np.array(generate_vectors(angles)))
+    vol_geom = astra.creators.create_vol_geom(ny,nx,nz)
+    sino_id, sino = astra.creators.create_sino3d_gpu(vol,proj_geom,vol_geom)
+    astra.data3d.delete(sino_id)
+    
+    return sino.astype(np.float32,copy=False)
+
 def generate_vectors(angles):
     """ Converts list of 3D projection angles into
-    list of astra-compatible projection vectors,
+    (N,12) array of astra-compatible projection vectors,
     with [r,d,u,v] vectors on each row. """
-    vectors = []
-    for [ax,ay,az] in angles:
-        vector = get_astravec(ax,ay,az)
-        vectors.append(vector)
+    # Same construction as get_astravec, for all angles at once
+    a = np.array(angles,dtype=np.float64).reshape(-1,3)
+    a[:,1] *= -1 # flipud on y axis means ay needs reversing
+    mrot = rotation_matrices(a,intrinsic=False)
+    
+    # Columns of mrot are the rotated x,y,z unit vectors
+    r = -mrot[:,:,2] # -1 to match astra definitions
+    d = np.zeros_like(r)
+    u = mrot[:,:,0]
+    v = mrot[:,:,1]
+    vectors = np.concatenate((r,d,u,v),axis=1)
     
     return vectors
 
@@ -772,31 +862,40 @@ def reorient_reconstruction(r,normalise=True):
         r = r -  r.min() # normalise
         r = r/r.max()
 
-    recon_vector = copy.deepcopy(r)
+    recon_vector = np.ascontiguousarray(r)
     
     return recon_vector
 
 def COD(P,recon):
     """ Calculate the coefficinet of determination (1 perfect, 0 shit)"""
-    P_mean = np.mean(P)
-    R_mean = np.mean(recon)
-    sumprod = np.sum((P-P_mean)*(recon-R_mean))
-    geom_mean = np.sqrt(np.sum((P-P_mean)**2)*np.sum((recon-R_mean)**2))
+    # Flattened, mean-subtracted copies so each sum is a single dot product
+    a = np.ravel(P - np.mean(P))
+    b = np.ravel(recon - np.mean(recon))
+    sumprod = a.dot(b)
+    geom_mean = np.sqrt(a.dot(a)*b.dot(b))
     coeff_norm = sumprod/geom_mean
     COD = coeff_norm**2
     
     return COD
 
 def error_opt(beta,recon,P):
-    a = np.linalg.norm(recon*beta-P)
-    b = np.linalg.norm(P)
+    d = np.ravel(recon*beta-P)
+    p = np.ravel(P)
+    a = np.sqrt(d.dot(d))
+    b = np.sqrt(p.dot(p))
     return a/b
 
 def phantom_error(P,recon,beta=1):
     """ Calculate normalised error between phantom and reconstruction
     (0 great, 1 shit) """
-    opt = optimize.minimize(error_opt,1,args=(recon,P))
-    err_phant = opt.fun
+    # The optimal scaling beta = r.P/r.r has a closed form, so the minimised
+    # ||beta*r - P||/||P|| only needs three dot products
+    r = np.ravel(recon)
+    p = np.ravel(P)
+    rP, rr, pp = float(r.dot(p)), float(r.dot(r)), float(p.dot(p))
+    if rr == 0:
+        return 1.0
+    err_phant = np.sqrt(max(pp - rP**2/rr,0))/np.sqrt(pp)
     return err_phant
 
 def projection_error(P,recon,angles,beta=1):
@@ -807,24 +906,28 @@ def projection_error(P,recon,angles,beta=1):
     err_proj = phantom_error(true_proj,recon_proj,1)
     return err_proj
 
-def noisy(image, noise_typ='gauss',g_var = 0.1, p_sp = 0.004,val_pois = None,sp_var=1):
+def noisy(image, noise_typ='gauss',g_var = 0.1, p_sp = 0.004,val_pois = None,sp_var=1,rng=None):
     """ Add noise to image with choice from:
     - 'gauss' for Gaussian noise w/ variance 'g_var'
     - 's&p' for salt & pepper noise with probability 'p_sp'
     - 'poisson' for shot noise with avg count of 'val_pois'
-    - 'speckle' for speckle noise w/ variance 'sp_var'"""
+    - 'speckle' for speckle noise w/ variance 'sp_var'
+    
+    rng = np.random.Generator to draw from. By default one is seeded from the global
+          np.random state, so np.random.seed still makes the noise reproducible
+          (the values differ from the old np.random.normal/poisson draws though) """
+    if rng is None:
+        rng = np.random.default_rng(np.random.randint(2**31))
     if noise_typ == "gauss":
         # INDEPENDENT (ADDITIVE)
         # Draw random samples from a Gaussian distribution
         # Add these to the image
         # Higher variance = more noise
-        row,col,ch= image.shape
-        mean = 0
         var = g_var
         sigma = var**0.5
-        gauss = np.random.normal(mean,sigma,(row,col,ch))
-        gauss = gauss.reshape(row,col,ch)
-        noisy = image + gauss
+        noisy = rng.standard_normal(image.shape,dtype=np.float32)
+        noisy *= sigma
+        noisy += image
         return noisy
     
     elif noise_typ == "s&p":
@@ -832,21 +935,17 @@ def noisy(image, noise_typ='gauss',g_var = 0.1, p_sp = 0.004,val_pois = None,sp_
         # Salt & pepper/spike/dropout noise will either
         # set random pixels to their max (salt) or min (pepper)
         # Quantified by the % of corrupted pixels
-        row,col,ch = image.shape
         s_vs_p = 0.5
         amount = p_sp
         out = np.copy(image)
+        # One uniform draw per pixel decides salt, pepper or unchanged
+        r = rng.random(image.shape,dtype=np.float32)
         # Salt mode
-        num_salt = np.ceil(amount * image.size * s_vs_p)
-        coords = [np.random.randint(0, i - 1, int(num_salt))
-              for i in image.shape] # randomly select coordinates
-        out[coords] = np.max(image) # set value to max
-
+        salt = r < amount*s_vs_p
         # Pepper mode
-        num_pepper = np.ceil(amount* image.size * (1. - s_vs_p))
-        coords = [np.random.randint(0, i - 1, int(num_pepper))
-              for i in image.shape] # randomly select coordinates
-        out[coords] = np.min(image) # set value to min
+        pepper = (r >= amount*s_vs_p) & (r < amount)
+        out[salt] = np.max(image) # set value to max
+        out[pepper] = np.min(image) # set value to min
         return out
     
     elif noise_typ == "poisson":
@@ -864,7 +963,8 @@ def noisy(image, noise_typ='gauss',g_var = 0.1, p_sp = 0.004,val_pois = None,sp_
         else:
             vals = val_pois
             
-        noisy = np.random.poisson(image * vals) / float(vals)
+        noisy = rng.poisson(image * vals).astype(np.float32)
+        noisy /= vals
         return noisy
     
     elif noise_typ =="speckle":
@@ -873,15 +973,14 @@ def noisy(image, noise_typ='gauss',g_var = 0.1, p_sp = 0.004,val_pois = None,sp_
         
         # Generate array in shape of image but with values
         # drawn from a Gaussian distribution
-        row,col,ch= image.shape
-        mean = 0
         var = sp_var
         sigma = var**0.5
-        gauss = np.random.normal(mean,sigma,(row,col,ch))
-        gauss = gauss.reshape(row,col,ch)
+        noisy = rng.standard_normal(image.shape,dtype=np.float32)
         
-        # Multiply image by dist. and add to image
-        noisy = image + image * gauss
+        # Multiply image by dist. and add to image, i.e. image*(1 + sigma*gauss)
+        noisy *= sigma
+        noisy += 1
+        noisy *= image
         return noisy
     
 def vec_to_ang(v):
@@ -892,21 +991,47 @@ def vec_to_ang(v):
     It works by first finding the axis of rotation from AxB,
     then getting the angle with atan(AxB/A.B).
     It then converts this to a rotation matrix and finally to 
-    Euler angles using another module"""
-    A = np.array([0,0,1])
-    B = np.array(v)
-
-    cross = np.cross(A, B)
-    dot = np.dot(A, B.transpose())
-    angle = np.arctan2(np.linalg.norm(cross), dot)
-    rotation_axes = normalize(cross)
-    rotation_m = transforms3d.axangles.axangle2mat(rotation_axes, angle, True)
-    rotation_angles = transforms3d.euler.mat2euler(rotation_m, 'sxyz')
-    
-    return np.array(rotation_angles)*180/np.pi
+    Euler angles (see vec_to_ang_batch)"""
+    return vec_to_ang_batch(np.reshape(v,(1,3)))[0]
+
+def vec_to_ang_batch(V):
+    """ vec_to_ang for an (N,3) array of vectors, returns (N,3) Euler angles in degrees
+    
+    Rotation matrices come from Rodrigues' formula and are converted to
+    static xyz Euler angles (as transforms3d mat2euler(M,'sxyz')), all
+    broadcast over N """
+    V = np.asarray(V,dtype=float)
+    x,y,z = V[:,0],V[:,1],V[:,2]
+
+    # With A = [0,0,1], AxB = [-y,x,0] and A.B = z
+    s = np.hypot(x,y)
+    angle = np.arctan2(s,z)
+    safe = np.where(s == 0, 1, s)
+    ux = np.where(s == 0, 1, -y/safe) # v along +-z, any axis in the xy plane works
+    uy = np.where(s == 0, 0, x/safe)
+
+    # Rodrigues: R = I + sin(a) K + (1-cos(a)) K^2, K the skew matrix of [ux,uy,0]
+    c, sn = np.cos(angle), np.sin(angle)
+    t = 1-c
+    R00 = 1 - t*uy*uy
+    R10 = t*ux*uy
+    R11 = 1 - t*ux*ux
+    R12 = -sn*ux
+    R20 = -sn*uy
+    R21 = sn*ux
+    R22 = c
+
+    # Static xyz Euler angles, with the gimbal lock branch where cos(ay) ~ 0
+    cy = np.hypot(R00,R10)
+    lock = cy <= 4*np.finfo(float).eps
+    ax = np.where(lock, np.arctan2(-R12,R11), np.arctan2(R21,R22))
+    ay = np.arctan2(-R20,cy)
+    az = np.where(lock, 0, np.arctan2(R10,R00))
+    
+    return np.stack([ax,ay,az],axis=1)*180/np.pi
 
 def normalize(v):
-    norm=np.linalg.norm(v, ord=1)
+    norm=np.linalg.norm(v)
     if norm==0:
         norm=np.finfo(v.dtype).eps
     return v/norm
@@ -918,8 +1043,9 @@ def compare_projection(recon_vector,P,ax=0,ay=0,az=0):
     fig= plt.figure(figsize=(12,6))
     ax1 = fig.add_subplot(1, 2, 1)
     ax2 = fig.add_subplot(1, 2, 2)
-    ax1.imshow(np.flipud(np.mean(a,axis=2).T))
-    ax2.imshow(np.flipud(np.mean(rotate_bulk(P,ax,ay,az),axis=2).T))
+    ax1.imshow(np.flipud(a.sum(axis=2,dtype=np.float32).T * (1/a.shape[2])))
+    Prot = rotate_bulk(P,ax,ay,az)
+    ax2.imshow(np.flipud(Prot.sum(axis=2,dtype=np.float32).T * (1/Prot.shape[2])))
     ax1.axis('off')
     ax2.axis('off')
     plt.tight_layout()
@@ -931,9 +1057,6 @@ def compare_projection(recon_vector,P,ax=0,ay=0,az=0):
 def compare_ortho(P,r,ax=0,ay=0,az=0,ix=None,iy=None,iz=None):
     """ Plot recon orthoslices above phantom orthoslices and print error metrics"""
     
-    Prot = rotate_bulk(P,ax,ay,az)
-    rrot = rotate_bulk(r,ax,ay,az)
-    
     fig = plt.figure(figsize=(12,8))
     ax1 = fig.add_subplot(2,3,1)
     ax2 = fig.add_subplot(2,3,2)
@@ -942,8 +1065,9 @@ def compare_ortho(P,r,ax=0,ay=0,az=0,ix=None,iy=None,iz=None):
     ax5 = fig.add_subplot(2,3,5)
     ax6 = fig.add_subplot(2,3,6)
 
-    plot_orthoslices(rrot,axs=[ax1,ax2,ax3],ix=ix,iy=iy,iz=iz)
-    plot_orthoslices(Prot,axs=[ax4,ax5,ax6],ix=ix,iy=iy,iz=iz)
+    # Only the three plotted planes are rotated
+    plot_orthoslices(r,axs=[ax1,ax2,ax3],ix=ix,iy=iy,iz=iz,rot=(ax,ay,az))
+    plot_orthoslices(P,axs=[ax4,ax5,ax6],ix=ix,iy=iy,iz=iz,rot=(ax,ay,az))
     
     ax3.set_title('YZ - Recon',fontsize=15,weight='bold')
     ax2.set_title('XZ - Recon',fontsize=15,weight='bold')
@@ -956,9 +1080,11 @@ def compare_ortho(P,r,ax=0,ay=0,az=0,ix=None,iy=None,iz=None):
     plt.tight_layout()
     print('Phantom error: ',phantom_error(P,r),'COD: ',COD(P,r))
     
-def plot_orthoslices(P,ix=None,iy=None,iz=None,axs=None):
+def plot_orthoslices(P,ix=None,iy=None,iz=None,axs=None,rot=None):
     """ Plot xy,xz,yz orthoslices of a 3d volume
-    Plots central slice by default, but slice can be specified """
+    Plots central slice by default, but slice can be specified
+    rot = (ax,ay,az) plots slices of rotate_bulk(P,ax,ay,az), resampling only
+    those planes (colour limits are then taken from the unrotated volume) """
     if axs == None:
         fig = plt.figure(figsize=(12,4))
         ax1 = fig.add_subplot(1,3,1)
@@ -982,9 +1108,14 @@ def plot_orthoslices(P,ix=None,iy=None,iz=None,axs=None):
     if iz != None:
         sz2 = iz
 
-    ax3.imshow(P[sx2,:,:],cmap='Greys_r',vmax=pmax,vmin=pmin)
-    ax2.imshow(P[:,sy2,:],cmap='Greys_r',vmax=pmax,vmin=pmin)
-    ax1.imshow(P[:,:,sz2],cmap='Greys_r',vmax=pmax,vmin=pmin)
+    if rot == None:
+        yz, xz, xy = P[sx2,:,:], P[:,sy2,:], P[:,:,sz2]
+    else:
+        yz, xz, xy = [rotate_slice(P,*rot,axis=i,idx=j) for i,j in enumerate([sx2,sy2,sz2])]
+
+    ax3.imshow(yz,cmap='Greys_r',vmax=pmax,vmin=pmin)
+    ax2.imshow(xz,cmap='Greys_r',vmax=pmax,vmin=pmin)
+    ax1.imshow(xy,cmap='Greys_r',vmax=pmax,vmin=pmin)
     
     
 
@@ -1002,7 +1133,7 @@ def plot_orthoslices(P,ix=None,iy=None,iz=None,axs=None):
     
 def full_tomo(P,Pn,scheme='x',a=70,b=40,g=180,alg='TV1',tilt2='gamma',n_tilt=40,angles = None,dist_n2=8,niter=300,callback_freq=50,weight=0.01,normalise=True):
     """ Given a phantom, returns reconstructed volume (and projection data and angles)"""
-    if angles == None:
+    if angles is None:
         angles = generate_angles(mode=scheme,alpha=a,beta=b,gamma=g,tilt2=tilt2,dist_n2=dist_n2,n_tilt=n_tilt)
     raw_data = generate_proj_data(Pn,angles,normalise=normalise)
     vectors = generate_vectors(angles)
@@ -1033,16 +1164,61 @@ def convertmag_T_Am(M_T):
 
 
 
+def _plan_components(plan_rot,Ms_Am):
+    """ (mx,my) of magnetisation Ms_Am rotated plan_rot degrees ac/w from +x """
+    a = math.radians(plan_rot)
+    return math.cos(a)*Ms_Am, math.sin(a)*Ms_Am
+
+@njit(parallel=True,cache=True)
+def _sphere_fill(MX,MY,ci,rad2,mx,my):
+    """ Set (MX,MY) = (mx,my) inside a sphere of squared radius rad2 (px) about voxel (ci,ci,ci) """
+    for i in prange(MX.shape[0]):
+        for j in range(MX.shape[1]):
+            for k in range(MX.shape[2]):
+                if (i-ci)**2 + (j-ci)**2 + (k-ci)**2 < rad2:
+                    MX[i,j,k] = mx
+                    MY[i,j,k] = my
+
+@njit(parallel=True,cache=True)
+def _disc_fill(MX,MY,ci,rad2,klo,khi,mx,my,vortex):
+    """ Fill a z-normal disc of squared radius rad2 (px) between klo < k < khi
+    with uniform (mx,my), or with a c/w vortex of magnitude mx if vortex is True """
+    for i in prange(MX.shape[0]):
+        for j in range(MX.shape[1]):
+            x, y = i-ci, j-ci
+            if x*x + y*y < rad2:
+                if vortex:
+                    # cos/sin of the angle between tangent and horizontal, -arctan2(x,y)
+                    r = np.sqrt(x*x + y*y)
+                    vx, vy = (y/r*mx, -x/r*mx) if r > 0 else (mx, 0.)
+                else:
+                    vx, vy = mx, my
+                for k in range(MX.shape[2]):
+                    if klo < k < khi:
+                        MX[i,j,k] = vx
+                        MY[i,j,k] = vy
+
+@njit(parallel=True,cache=True)
+def _rod_fill(MX,ci,rad2,ilo,ihi,mx):
+    """ Set MX = mx inside an x-aligned rod of squared radius rad2 (px) between ilo < i < ihi """
+    for i in prange(MX.shape[0]):
+        if ilo < i < ihi:
+            for j in range(MX.shape[1]):
+                for k in range(MX.shape[2]):
+                    if (j-ci)**2 + (k-ci)**2 < rad2:
+                        MX[i,j,k] = mx
+
 class Magnetic_Phantom():
     """ Class for creating magnetic phantoms """
 
-    def sphere(rad_m = 10*1e-9, Ms_Am = 797700, plan_rot=0, bbox_length_m = 100*1e-9, bbox_length_px = 100):
+    def sphere(rad_m = 10*1e-9, Ms_Am = 797700, plan_rot=0, bbox_length_m = 100*1e-9, bbox_length_px = 100,backend='numpy'):
         """ Creates uniformly magnetised sphere
             rad_m : Radius in metres
             Ms_Am : Magnetisation in A/m
             plan_rot : Direction of magnetisation, rotated in degrees ac/w from +x
             bbox_length_m : Length in metres of one side of the bounding box
-            bbox_length_px : Length in pixels of one side of the bounding box """
+            bbox_length_px : Length in pixels of one side of the bounding box
+            backend : 'numpy' (broadcast mask) or 'numba' (compiled voxel loop) """
         # Initialise bounding box parameters
         p1 = (0,0,0)
         p2 = (bbox_length_m,bbox_length_m,bbox_length_m)
@@ -1052,22 +1228,21 @@ class Magnetic_Phantom():
         ci = int(bbox_length_px/2) # index of bbox centre
         
         # Initialise magnetisation arrays
-        mx = np.linspace(0,bbox_length_m,num=bbox_length_px) * 0
-        my,mz = mx,mx
-        MX, MY, MZ = np.meshgrid(mx, my, mz, indexing='ij')
+        MX = np.zeros(n,dtype=np.float32)
+        MY = np.zeros(n,dtype=np.float32)
+        MZ = np.zeros(n,dtype=np.float32)
+
+        mx, my = _plan_components(plan_rot,Ms_Am)
+
+        if backend == 'numba':
+            _sphere_fill(MX,MY,ci,(rad_m/res)**2,mx,my)
+            return MX,MY,MZ, mesh_params
 
         # Assign magnetisation
-        for i,a in enumerate(MX):
-            for j,b in enumerate(a):
-                for k,c in enumerate(b):
-                    if (i-ci)**2 + (j-ci)**2 + (k-ci)**2 < (rad_m/res)**2:
-                        MX[i,j,k] = np.cos(plan_rot*np.pi/180)*Ms_Am
-                        MY[i,j,k] = np.sin(plan_rot*np.pi/180)*Ms_Am
-        
-        
-        MX=MX.astype(np.float32)
-        MY=MY.astype(np.float32)
-        MZ=MZ.astype(np.float32)
+        I,J,K = np.ogrid[:n[0],:n[1],:n[2]]
+        mask = (I-ci)**2 + (J-ci)**2 + (K-ci)**2 < (rad_m/res)**2
+        MX[mask] = mx
+        MY[mask] = my
 
         return MX,MY,MZ, mesh_params
     
@@ -1089,46 +1264,44 @@ class Magnetic_Phantom():
         ciy = int(n[1]/2) # index of bbox centre
         ciz = int(n[2]/2) # index of bbox centre
 
+        def index_slice(ci,l,res,ni):
+            """ Slice of indices i with ci-l/2 < i < ci+l/2 (in px), clipped to the box """
+            lo = int(np.floor(ci-.5*l/res))+1
+            hi = int(np.ceil(ci+.5*l/res))
+            return slice(min(max(lo,0),ni),min(max(hi,0),ni))
+
         # Initialise magnetisation arrays
-        mx = np.linspace(0,p2[0],num=n[0]) * 0
-        my = np.linspace(0,p2[1],num=n[1]) * 0
-        mz = np.linspace(0,p2[2],num=n[2]) * 0
-        MX, MY, MZ = np.meshgrid(mx, my, mz, indexing='ij')
+        MX = np.zeros(n,dtype=np.float32)
+        MY = np.zeros(n,dtype=np.float32)
+        MZ = np.zeros(n,dtype=np.float32)
 
         # Assign magnetisation
-        for i,a in enumerate(MX):
-            for j,b in enumerate(a):
-                for k,c in enumerate(b):
-                    if cix-.5*lx_m/resx < i < cix+.5*lx_m/resx and \
-                       ciy-.5*ly_m/resy < j < ciy+.5*ly_m/resy and \
-                       ciz-.5*lz_m/resz < k < ciz+.5*lz_m/resz:
-                        MX[i,j,k] = np.cos(plan_rot*np.pi/180)*Ms_Am
-                        MY[i,j,k] = np.sin(plan_rot*np.pi/180)*Ms_Am
-
-        MX=MX.astype(np.float32)
-        MY=MY.astype(np.float32)
-        MZ=MZ.astype(np.float32)
+        box = (index_slice(cix,lx_m,resx,n[0]),
+               index_slice(ciy,ly_m,resy,n[1]),
+               index_slice(ciz,lz_m,resz,n[2]))
+        MX[box], MY[box] = _plan_components(plan_rot,Ms_Am)
         
         return MX,MY,MZ, mesh_params
     
     def disc_vortex(rad_m = 30*1e-9, lz_m = 20*1e-9, Ms_Am = 797700, 
-                  plan_rot=0, bbox_length_m = 100*1e-9, bbox_length_px = 100):
+                  plan_rot=0, bbox_length_m = 100*1e-9, bbox_length_px = 100,backend='numpy'):
         """ Creates disk with c/w vortex magnetisation
             rad_m : Radius in metres
             lz_m = thickness of disc in metres
             Ms_Am : Magnetisation in A/m
             plan_rot : Direction of magnetisation, rotated in degrees ac/w from +x
             bbox_length_m : Length in metres of one side of the bounding box
-            bbox_length_px : Length in pixels of one side of the bounding box """
+            bbox_length_px : Length in pixels of one side of the bounding box
+            backend : 'numpy' (broadcast mask) or 'numba' (compiled voxel loop) """
         
         def vortex(x,y):
             """ Returns mx/my components for vortex state, 
             given input x and y """
-            # angle between tangent and horizontal
-            theta=-1*np.arctan2(x,y)
-            # cosine/sine components
-            C=np.cos(theta)
-            S = np.sin(theta)
+            # cosine/sine of the angle between tangent and horizontal,
+            # theta = -arctan2(x,y), written without trig (theta = 0 at the centre)
+            r = np.hypot(x,y)
+            C = np.divide(y,r,out=np.ones(r.shape),where=r>0)
+            S = np.divide(-x,r,out=np.zeros(r.shape),where=r>0)
             return C, S
         
         # Initialise bounding box parameters
@@ -1140,35 +1313,34 @@ class Magnetic_Phantom():
         ci = int(bbox_length_px/2) # index of bbox centre
         
         # Initialise magnetisation arrays
-        mx = np.linspace(0,bbox_length_m,num=bbox_length_px) * 0
-        my,mz = mx,mx
-        MX, MY, MZ = np.meshgrid(mx, my, mz, indexing='ij')
+        MX = np.zeros(n,dtype=np.float32)
+        MY = np.zeros(n,dtype=np.float32)
+        MZ = np.zeros(n,dtype=np.float32)
+
+        if backend == 'numba':
+            _disc_fill(MX,MY,ci,(rad_m/res)**2,ci-.5*lz_m/res,ci+.5*lz_m/res,Ms_Am,0.,True)
+            return MX,MY,MZ, mesh_params
 
         # Assign magnetisation
-        for i,a in enumerate(MX):
-            for j,b in enumerate(a):
-                for k,c in enumerate(b):
-                    if (i-ci)**2 + (j-ci)**2 < (rad_m/res)**2 and ci-.5*lz_m/res < k < ci+.5*lz_m/res:
-                        mx,my = vortex(i-ci,j-ci)
-                        MX[i,j,k] = mx*Ms_Am
-                        MY[i,j,k] = my*Ms_Am
-                        
-        
-        MX=MX.astype(np.float32)
-        MY=MY.astype(np.float32)
-        MZ=MZ.astype(np.float32)
+        I,J,K = np.ogrid[:n[0],:n[1],:n[2]]
+        x,y = I-ci,J-ci
+        mask = (x**2 + y**2 < (rad_m/res)**2) & (ci-.5*lz_m/res < K) & (K < ci+.5*lz_m/res)
+        mx,my = vortex(x,y)
+        MX[...] = np.where(mask,mx*Ms_Am,0)
+        MY[...] = np.where(mask,my*Ms_Am,0)
         
         return MX,MY,MZ, mesh_params
     
     def disc_uniform(rad_m = 30*1e-9, lz_m = 20*1e-9, Ms_Am = 797700, 
-                  plan_rot=0, bbox_length_m = 100*1e-9, bbox_length_px = 100):
+                  plan_rot=0, bbox_length_m = 100*1e-9, bbox_length_px = 100,backend='numpy'):
         """ Creates disk with c/w vortex magnetisation
             rad_m : Radius in metres
             lz_m = thickness of disc in metres
             Ms_Am : Magnetisation in A/m
             plan_rot : Direction of magnetisation, rotated in degrees ac/w from +x
             bbox_length_m : Length in metres of one side of the bounding box
-            bbox_length_px : Length in pixels of one side of the bounding box """
+            bbox_length_px : Length in pixels of one side of the bounding box
+            backend : 'numpy' (broadcast mask) or 'numba' (compiled voxel loop) """
         
         # Initialise bounding box parameters
         p1 = (0,0,0)
@@ -1179,22 +1351,22 @@ class Magnetic_Phantom():
         ci = int(bbox_length_px/2) # index of bbox centre
         
         # Initialise magnetisation arrays
-        mx = np.linspace(0,bbox_length_m,num=bbox_length_px) * 0
-        my,mz = mx,mx
-        MX, MY, MZ = np.meshgrid(mx, my, mz, indexing='ij')
+        MX = np.zeros(n,dtype=np.float32)
+        MY = np.zeros(n,dtype=np.float32)
+        MZ = np.zeros(n,dtype=np.float32)
+
+        mx, my = _plan_components(plan_rot,Ms_Am)
+
+        if backend == 'numba':
+            _disc_fill(MX,MY,ci,(rad_m/res)**2,ci-.5*lz_m/res,ci+.5*lz_m/res,mx,my,False)
+            return MX,MY,MZ, mesh_params
 
         # Assign magnetisation
-        for i,a in enumerate(MX):
-            for j,b in enumerate(a):
-                for k,c in enumerate(b):
-                    if (i-ci)**2 + (j-ci)**2 < (rad_m/res)**2 and ci-.5*lz_m/res < k < ci+.5*lz_m/res:
-                        MX[i,j,k] = np.cos(plan_rot*np.pi/180)*Ms_Am
-                        MY[i,j,k] = np.sin(plan_rot*np.pi/180)*Ms_Am
-                        
-        
-        MX=MX.astype(np.float32)
-        MY=MY.astype(np.float32)
-        MZ=MZ.astype(np.float32)
+        I,J,K = np.ogrid[:n[0],:n[1],:n[2]]
+        x,y = I-ci,J-ci
+        mask = (x**2 + y**2 < (rad_m/res)**2) & (ci-.5*lz_m/res < K) & (K < ci+.5*lz_m/res)
+        MX[mask] = mx
+        MY[mask] = my
         
         return MX,MY,MZ, mesh_params
     
@@ -1217,42 +1389,38 @@ class Magnetic_Phantom():
         ci = int(bbox_length_px/2) # index of bbox centre
         
         # Initialise magnetisation arrays
-        mx = np.linspace(0,bbox_length_m,num=bbox_length_px) * 0
-        my,mz = mx,mx
-        MX, MY, MZ = np.meshgrid(mx, my, mz, indexing='ij')
+        MX = np.zeros(n,dtype=np.float32)
+        MY = np.zeros(n,dtype=np.float32)
+        MZ = np.zeros(n,dtype=np.float32)
         
         # Define gradient/intercept of bounding lines
         m1, c1 = 5/(100*1e-9)*bbox_length_m,   100 /100*bbox_length_px
         m2, c2 = 0,                            -25 /100*bbox_length_px
         m3, c3 = -0.6/(100*1e-9)*bbox_length_m, 0
 
-        # Assign magnetisation
-        for i,a in enumerate(MX):
-            for j,b in enumerate(a):
-                for k,c in enumerate(b):
-                    x = i-ci
-                    y = j-ci
-                    z = k-ci
-                    if y < (m1*x+c1) and y > (m2*x + c2) and y < (m3*x + c3) and ((z >-20/100*bbox_length_px and z<-10/100*bbox_length_px) or (z>0 and z<30/100*bbox_length_px)):
-                        MX[i,j,k] = Ms_Am
+        # Voxel offsets from the box centre, broadcastable to n
+        I,J,K = np.ogrid[:n[0],:n[1],:n[2]]
+        x,y,z = I-ci,J-ci,K-ci
+
+        # Assign magnetisation (triangle in xy from three half planes, two z layers)
+        tri = (y < m1*x+c1) & (y > m2*x + c2) & (y < m3*x + c3)
+        layers = ((z > -20/100*bbox_length_px) & (z < -10/100*bbox_length_px)) | ((z > 0) & (z < 30/100*bbox_length_px))
+        MX[tri & layers] = Ms_Am
                         
         #MX = np.swapaxes(MX,0,1)
-                        
-        MX=MX.astype(np.float32)
-        MY=MY.astype(np.float32)
-        MZ=MZ.astype(np.float32)
         
         return MX,MY,MZ, mesh_params
     
     def rod(rad_m = 10*1e-9, lx_m = 60*1e-9, Ms_Am = 797700, 
-                  plan_rot=0, bbox_length_m = 100*1e-9, bbox_length_px = 100):
+                  plan_rot=0, bbox_length_m = 100*1e-9, bbox_length_px = 100,backend='numpy'):
         """ Creates uniformly magnetised cylindrical rod lying along x
             rad_m : Radius in metres
             lx_m = length of rod in metres
             Ms_Am : Magnetisation in A/m
             plan_rot : Direction of magnetisation, rotated in degrees ac/w from +x
             bbox_length_m : Length in metres of one side of the bounding box
-            bbox_length_px : Length in pixels of one side of the bounding box """
+            bbox_length_px : Length in pixels of one side of the bounding box
+            backend : 'numpy' (broadcast mask) or 'numba' (compiled voxel loop) """
         
         # Initialise bounding box parameters
         p1 = (0,0,0)
@@ -1263,26 +1431,22 @@ class Magnetic_Phantom():
         ci = int(bbox_length_px/2) # index of bbox centre
         
         # Initialise magnetisation arrays
-        mx = np.linspace(0,bbox_length_m,num=bbox_length_px) * 0
-        my,mz = mx,mx
-        MX, MY, MZ = np.meshgrid(mx, my, mz, indexing='ij')
+        MX = np.zeros(n,dtype=np.float32)
+        MY = np.zeros(n,dtype=np.float32)
+        MZ = np.zeros(n,dtype=np.float32)
+
+        if backend == 'numba':
+            _rod_fill(MX,ci,(rad_m/res)**2,ci-.5*lx_m/res,ci+.5*lx_m/res,Ms_Am)
+            return MX,MY,MZ, mesh_params
 
         # Assign magnetisation
-        for i,a in enumerate(MX):
-            for j,b in enumerate(a):
-                for k,c in enumerate(b):
-                    x = i-ci
-                    y = j-ci
-                    z = k-ci
-                    if (k-ci)**2 + (j-ci)**2 < (rad_m/res)**2 and ci-.5*lx_m/res < i < ci+.5*lx_m/res:
-                        MX[i,j,k] = Ms_Am
+        I,J,K = np.ogrid[:n[0],:n[1],:n[2]]
+        y,z = J-ci,K-ci
+        mask = (z**2 + y**2 < (rad_m/res)**2) & (ci-.5*lx_m/res < I) & (I < ci+.5*lx_m/res)
+        MX[mask] = Ms_Am
                         
         #MX = np.swapaxes(MX,0,1)
-                        
-        MX=MX.astype(np.float32)
-        MY=MY.astype(np.float32)
-        MZ=MZ.astype(np.float32)
-        
+
         return MX,MY,MZ, mesh_params
     
     def hopfion(bbox_length_m = 100*1e-9, bbox_length_px = 100, L=30, core_only=True,core_rad=27.5, core_thresh=0.7, core_innerrad=5, core_height=15, Ms_Am = 384000):
@@ -1326,52 +1490,29 @@ class Magnetic_Phantom():
             phi = np.arctan2(y, x)
             return(rho, phi)
 
-        mx = np.linspace(0,bbox_length_m,num=bbox_length_px) * 0
-        my,mz = mx,mx
-        MX, MY, MZ = np.meshgrid(mx, my, mz, indexing='ij')
-        cent = int(bbox_length_px/2)
+        n = bbox_length_px
+        cent = int(n/2)
+        # Voxel offsets from the centre, broadcastable to (n,n,n)
+        x,y,z = np.ogrid[-cent:n-cent,-cent:n-cent,-cent:n-cent]
         # Assign magnetisation
-        for i,a in enumerate(MX):
-            for j,b in enumerate(a):
-                for k,c in enumerate(b):
-                    x,y,z = i-cent,j-cent,k-cent
-                    rho,theta = cart2cyl(x,y)
-                    mx,my,mz = calc_m(theta,rho,z,L)
-                    MX[i,j,k] = mx
-                    MY[i,j,k] = my
-                    MZ[i,j,k] = mz
+        rho,theta = cart2cyl(x,y)
+        MX,MY,MZ = calc_m(theta,rho,z,L)
 
         # Reorient y
         MY = -MY[::1,::-1,::1]
 
         if core_only == True:
-            for i,a in enumerate(MX):
-                for j,b in enumerate(a):
-                    for k,c in enumerate(b):
-                        x,y,z = i-cent,j-cent,k-cent
-
-                        # Limit M to be only non-zero within hopfion core
-                        # set to zero beyond outer radius
-                        if x**2+y**2 > core_rad**2:
-                            MX[i,j,k]=0
-                            MY[i,j,k]=0
-                            MZ[i,j,k]=0
-
-                        # Set to zero above threshold and below inner radius
-                        if abs(MZ[i,j,k])>core_thresh and x**2+y**2 < core_innerrad**2:
-                            MX[i,j,k]=0
-                            MY[i,j,k]=0
-                            MZ[i,j,k]=0
-
-                        # Set to zero beyond height limits
-                        if abs(z)>core_height:
-                            MX[i,j,k]=0
-                            MY[i,j,k]=0
-                            MZ[i,j,k]=0
-                        if MZ[i,j,k]>core_thresh:
-                            MX[i,j,k]=0
-                            MY[i,j,k]=0
-                            MZ[i,j,k]=0
+            r2 = x**2+y**2
+            # Limit M to be only non-zero within hopfion core:
+            # beyond outer radius, above threshold and below inner radius,
+            # beyond height limits, or above threshold
+            mask = (r2 > core_rad**2) | \
+                   ((abs(MZ) > core_thresh) & (r2 < core_innerrad**2)) | \
+                   (abs(z) > core_height) | \
+                   (MZ > core_thresh)
+            MX[mask]=0
+            MY[mask]=0
+            MZ[mask]=0
                             
         MX = MX*Ms_Am
         MY = MY*Ms_Am
@@ -1392,11 +1533,11 @@ class Magnetic_Phantom():
         def vortex(x,y):
             """ Returns mx/my components for vortex state, 
             given input x and y """
-            # angle between tangent and horizontal
-            theta=-1*np.arctan2(x,y)
-            # cosine/sine components
-            C=np.cos(theta)
-            S = np.sin(theta)
+            # cosine/sine of the angle between tangent and horizontal,
+            # theta = -arctan2(x,y), written without trig (theta = 0 at the centre)
+            r = np.hypot(x,y)
+            C = np.divide(y,r,out=np.ones(r.shape),where=r>0)
+            S = np.divide(-x,r,out=np.zeros(r.shape),where=r>0)
             return C, S
         
         # Initialise bounding box parameters
@@ -1408,53 +1549,27 @@ class Magnetic_Phantom():
         ci = int(bbox_length_px/2) # index of bbox centre
         
         # Initialise magnetisation arrays
-        mx = np.linspace(0,bbox_length_m,num=bbox_length_px) * 0
-        my,mz = mx,mx
-        MX, MY, MZ = np.meshgrid(mx, my, mz, indexing='ij')
-
-        # Assign magnetisation
-        for i,a in enumerate(MX):
-            for j,b in enumerate(a):
-                for k,c in enumerate(b):
-                    if (i-ci)**2 + (j-ci)**2 < (rad_m/res)**2 and ci-.5*lz_m/res < k < ci+.5*lz_m/res:
-                        mx,my = vortex(i-ci,j-ci)
-                        MX[i,j,k] = mx*Ms_Am
-                        MY[i,j,k] = my*Ms_Am
-                        
-        # Assign magnetisation
-        for i,a in enumerate(MX):
-            for j,b in enumerate(a):
-                for k,c in enumerate(b):
-                    if (j-ci)>0 and abs(i-ci)<10:
-                        mx,my = 0,0
-                        MX[i,j,k] = mx*Ms_Am
-                        MY[i,j,k] = my*Ms_Am
-                        
-        for i,a in enumerate(MX):
-            for j,b in enumerate(a):
-                for k,c in enumerate(b):
-                    if rad_m/res>(j-ci)>0 and 9<(i-ci)<rad_m/res-1:
-                        mx,my = 0,-1
-                        MX[i,j,k] = mx*Ms_Am
-                        MY[i,j,k] = my*Ms_Am
-                    elif rad_m/res>(j-ci)>0 and -rad_m/res+1<(i-ci)<-9:
-                        mx,my = 0,1
-                        MX[i,j,k] = mx*Ms_Am
-                        MY[i,j,k] = my*Ms_Am
-                        
-        for i,a in enumerate(MX):
-            for j,b in enumerate(a):
-                for k,c in enumerate(b):
-                    if not ci-.5*lz_m/res < k < ci+.5*lz_m/res:
-                        mx,my = 0,0
-                        MX[i,j,k] = mx*Ms_Am
-                        MY[i,j,k] = my*Ms_Am
-                
-                        
-        
-        MX=MX.astype(np.float32)
-        MY=MY.astype(np.float32)
-        MZ=MZ.astype(np.float32)
+        MX = np.zeros(n,dtype=np.float32)
+        MY = np.zeros(n,dtype=np.float32)
+        MZ = np.zeros(n,dtype=np.float32)
+
+        # Voxel offsets from the box centre in x/y, broadcastable to n
+        I,J,K = np.ogrid[:n[0],:n[1],:n[2]]
+        x,y = I-ci,J-ci
+
+        r = rad_m/res
+        # Regions, with later regions overriding earlier ones
+        disc = x**2 + y**2 < r**2                    # vortex disc
+        gap = (y > 0) & (abs(x) < 10)                # cut out of the top of the disc
+        leg_r = (r > y) & (y > 0) & (9 < x) & (x < r-1)   # right leg, pointing -y
+        leg_l = (r > y) & (y > 0) & (-r+1 < x) & (x < -9) # left leg, pointing +y
+        outside = ~((ci-.5*lz_m/res < K) & (K < ci+.5*lz_m/res)) # beyond disc thickness
+        
+        # Assign magnetisation (np.select takes the first matching region)
+        regions = [outside,leg_r,leg_l,gap,disc]
+        mx,my = vortex(x,y)
+        MX[...] = np.select(regions,[0,0,0,0,mx*Ms_Am],0)
+        MY[...] = np.select(regions,[0,-Ms_Am,Ms_Am,0,my*Ms_Am],0)
         
         return MX,MY,MZ, mesh_params
 
@@ -1462,8 +1577,10 @@ def plot_2d_mag(mx,my,mz=None,mesh_params=None,Ms=None,s=1):
     """ Takes x/y magnetisation projections and creates a plot
         uses quivers for direction and colour for magnitude 
         if mz is None, coloured by magnitude of x/y, else coloured by z"""
+    # In-plane magnitude, computed once for both Ms and the colour map
+    mag_xy = np.hypot(mx,my)
     if type(Ms) == type(None):
-        Ms = np.max(np.max((mx**2+my**2)**.5))
+        Ms = float(mag_xy.max())
     
     fig = plt.figure(figsize=(5, 5))
     ax = plt.gca()
@@ -1478,11 +1595,12 @@ def plot_2d_mag(mx,my,mz=None,mesh_params=None,Ms=None,s=1):
         
     x = np.linspace(p1[0],p2[0],num=n[0])
     y = np.linspace(p1[1],p2[1],num=n[1])
-    xs,ys = np.meshgrid(x,y)
+    xs,ys = np.meshgrid(x[::s],y[::s])
     
-    plt.quiver(xs[::s,::s],ys[::s,::s],mx[::s,::s].T,my[::s,::s].T,pivot='mid',scale=Ms*22,width=0.009,headaxislength=5,headwidth=4,minshaft=1.8)
+    # .T on the strided slices are views, no copies are made
+    plt.quiver(xs,ys,mx[::s,::s].T,my[::s,::s].T,pivot='mid',scale=Ms*22,width=0.009,headaxislength=5,headwidth=4,minshaft=1.8)
     if type(mz) == type(None):
-        mag = (mx**2+my**2)**.5
+        mag = mag_xy
     else:
         mag = mz
     plt.imshow(mag.T,origin='lower',extent=[p1[0],p2[0],p1[1],p2[1]],vmin=-Ms,vmax=Ms,cmap='RdBu')
@@ -1496,10 +1614,11 @@ def plot_2d_mag(mx,my,mz=None,mesh_params=None,Ms=None,s=1):
     plt.ylabel('y / m',fontsize=15)
     plt.show()
     
-def project_along_z(U,mesh_params=None):
+def project_along_z(U,mesh_params=None,out=None):
     """ Takes a 3D array and projects along the z component 
     It does this by multiplying each layer by its thickness
-    and then summing down the axis. """
+    and then summing down the axis.
+    out = optional preallocated 2D result array, for use in loops """
     if type(mesh_params) == type(None):
         p1 = (0,0,0)
         sx,sy,sz = np.shape(U)
@@ -1512,12 +1631,173 @@ def project_along_z(U,mesh_params=None):
     z_size = p2[2]
     z_res = z_size/n[2]
     
-    # project
-    u_proj = np.sum(U*z_res,axis=2)
+    # project (sum first then scale the 2D result, so no scaled copy of U is made)
+    u_proj = np.sum(U,axis=2,dtype=np.result_type(U,np.float32),out=out)
+    u_proj *= z_res
     
     return u_proj
 
-def calculate_A_3D(MX,MY,MZ, mesh_params=None,n_pad=100,tik_filter=0.01):
+def _k2_inv(K2,tik,xp=np):
+    """ Overwrite K2 = |k|^2 with the Tikhonov filtered 1/(|k| + tik)^2 using
+    in-place ufuncs (no temporaries). Where |k| + tik = 0 the result is 0 """
+    xp.sqrt(K2,out=K2)
+    K2 += tik
+    if tik == 0:
+        K2[(0,)*K2.ndim] = xp.inf # k = 0 is the first entry of an unshifted FFT grid
+    xp.multiply(K2,K2,out=K2)
+    xp.reciprocal(K2,out=K2)
+    return K2
+
+@lru_cache(maxsize=16)
+def _k_grids_2d(shape,resx,resy,tik,dtype=np.float32,real=True):
+    """ KX, KY and the filtered 1/k^2 (see _k2_inv) for a 2D FFT of the given shape,
+    cached so repeated calls with the same grid (e.g. over a tilt series) reuse them.
+    real = True gives the rfft2 half grid, with k-linear terms zeroed at the Nyquist
+    frequency (they cancel in the real part of a full inverse FFT).
+    The arrays are shared between calls so are returned read-only """
+    kx = spfft.fftfreq(shape[0],d=resx).astype(dtype)
+    if real:
+        ky = spfft.rfftfreq(shape[1],d=resy).astype(dtype)
+    else:
+        ky = spfft.fftfreq(shape[1],d=resy).astype(dtype)
+    KX, KY = np.meshgrid(kx,ky, indexing='ij') # Create a grid of coordinates
+    K2_inv = _k2_inv(KX*KX + KY*KY, tik)
+    
+    if real:
+        if shape[0] % 2 == 0: KX[shape[0]//2,:] = 0
+        if shape[1] % 2 == 0: KY[:,shape[1]//2] = 0
+    
+    for a in (KX,KY,K2_inv):
+        a.flags.writeable = False
+    return KX, KY, K2_inv
+
+@njit(parallel=True,cache=True)
+def _A_kspace_kernel(ft_mx,ft_my,ft_mz,kx,ky,kz,kxo,kyo,kzo,tik,pre):
+    """ Overwrite FT(M) in place with FT(A) = pre * (FT(M) x k) / (|k| + tik)^2
+    (zero where the denominator is zero), taking k from 1D kx,ky,kz.
+    kxo,kyo,kzo are the same with the Nyquist entry zeroed, used for the cross product """
+    for i in prange(ft_mx.shape[0]):
+        for j in range(ft_mx.shape[1]):
+            for l in range(ft_mx.shape[2]):
+                k = np.sqrt(kx[i]**2 + ky[j]**2 + kz[l]**2) + tik
+                f = pre/(k*k) if k != 0 else 0j
+                mx, my, mz = ft_mx[i,j,l], ft_my[i,j,l], ft_mz[i,j,l]
+                ft_mx[i,j,l] = f*(my*kzo[l] - mz*kyo[j])
+                ft_my[i,j,l] = f*(-mx*kzo[l] + mz*kxo[i])
+                ft_mz[i,j,l] = f*(-my*kxo[i] + mx*kyo[j])
+
+class AFieldSolver():
+    """ Calculates the magnetic vector potential of 3D magnetisation arrays of a fixed shape.
+    Padded buffers, k vectors and the 1/k^2 filter are set up once in __init__, so
+    repeated solve() calls (e.g. over many projections) only copy M in and run the FFTs """
+
+    def __init__(self,shape,mesh_params=None,n_pad=100,tik_filter=0.01,backend='numpy'):
+        """ shape : (nx,ny,nz) of the M arrays to be passed to solve()
+            Other arguments as for calculate_A_3D """
+        if mesh_params == None:
+            p1 = (0,0,0)
+            sx,sy,sz = shape
+            p2 = (sx,sy,sx)
+            n = p2
+        else:
+            p1,p2,n = mesh_params
+        self.backend = backend
+        
+        # Array and FFT modules for the chosen backend
+        if backend == 'cupy':
+            self.xp, self.fft, self.fft_kw = cp, cupyx_fft, {}
+        else:
+            self.xp, self.fft, self.fft_kw = np, spfft, {'workers':-1}
+        xp, fft = self.xp, self.fft
+        
+        # Zero padded float32 buffers for M, solve() only overwrites the centre
+        # (padding avoids FT convolution wrap-around artefacts)
+        self.shape = shape = tuple(s+2*n_pad for s in shape)
+        self.inner = tuple(slice(n_pad,s-n_pad) for s in shape)
+        self.mxpad = xp.zeros(shape,dtype=np.float32)
+        self.mypad = xp.zeros(shape,dtype=np.float32)
+        self.mzpad = xp.zeros(shape,dtype=np.float32)
+        
+        # Generate K values
+        resx = p2[0]/n[0] # resolution in m per px 
+        resy = p2[1]/n[1] # resolution in m per px 
+        resz = p2[2]/n[2] # resolution in m per px 
+
+        kx = fft.fftfreq(shape[0],d=resx).astype(np.float32)
+        ky = fft.fftfreq(shape[1],d=resy).astype(np.float32)
+        kz = fft.rfftfreq(shape[2],d=resz).astype(np.float32)
+        
+        # vacuum permeability
+        mu0 = 4*np.pi*1e-7
+        
+        self.fused = backend != 'cupy' and has_numba
+        if self.fused:
+            # 1D k vectors for the fused numba kernel, no k grids are needed
+            kxo, kyo, kzo = kx.copy(), ky.copy(), kz.copy()
+            if shape[0] % 2 == 0: kxo[shape[0]//2] = 0
+            if shape[1] % 2 == 0: kyo[shape[1]//2] = 0
+            if shape[2] % 2 == 0: kzo[shape[2]//2] = 0
+            self.k = (kx,ky,kz,kxo,kyo,kzo,np.float32(tik_filter*resx),np.complex64(-1j*mu0))
+        
+        else:
+            KX, KY, KZ = xp.meshgrid(kx,ky,kz, indexing='ij') # Create a grid of coordinates
+        
+            # Calculate 1/k^2 with Tikhanov filter
+            K2_inv = _k2_inv(KX*KX + KY*KY + KZ*KZ, tik_filter*resx, xp)
+        
+            # Terms linear in k cancel at the Nyquist frequency in the real part of a
+            # full inverse FFT, so zero them there to get the same result from irfftn
+            if shape[0] % 2 == 0: KX[shape[0]//2,:,:] = 0
+            if shape[1] % 2 == 0: KY[:,shape[1]//2,:] = 0
+            if shape[2] % 2 == 0: KZ[:,:,shape[2]//2] = 0
+            
+            self.KX, self.KY, self.KZ = KX, KY, KZ
+            self.K2_inv = -1j * mu0 * K2_inv
+        
+        # new mesh parameters (with padding)
+        n = (n[0]+2*n_pad,n[1]+2*n_pad,n[2]+2*n_pad)
+        p2 = (p2[0]+2*n_pad*resx,p2[1]+2*n_pad*resy,p2[2]+2*n_pad*resz)
+        self.mesh_params = (p1,p2,n)
+    
+    def solve(self,MX,MY,MZ):
+        """ Input(3D (nx,ny,nz) array for each component of M) and return
+        three padded 3D float32 arrays of magnetic vector potential and the padded mesh parameters """
+        xp, fft = self.xp, self.fft
+        
+        # Copy M into the centre of the padded buffers (cast to float32 on assignment)
+        self.mxpad[self.inner] = xp.asarray(MX)
+        self.mypad[self.inner] = xp.asarray(MY)
+        self.mzpad[self.inner] = xp.asarray(MZ)
+        
+        # take 3D FT of M (real input, so only kz >= 0 is needed)
+        ft_mx = fft.rfftn(self.mxpad,**self.fft_kw)
+        ft_my = fft.rfftn(self.mypad,**self.fft_kw)
+        ft_mz = fft.rfftn(self.mzpad,**self.fft_kw)
+        
+        if self.fused:
+            # Fused pass over k: FT(M) is overwritten by FT(A)
+            _A_kspace_kernel(ft_mx,ft_my,ft_mz,*self.k)
+            ft_Ax, ft_Ay, ft_Az = ft_mx, ft_my, ft_mz
+        
+        else:
+            KX, KY, KZ = self.KX, self.KY, self.KZ
+            
+            # Calculate A(k) from M cross K
+            ft_Ax = self.K2_inv * (ft_my*KZ - ft_mz*KY)
+            ft_Ay = self.K2_inv * (-ft_mx*KZ + ft_mz*KX)
+            ft_Az = self.K2_inv * (-ft_my*KX + ft_mx*KY)
+        
+        # Inverse fourier transform
+        AX = fft.irfftn(ft_Ax,s=self.shape,overwrite_x=True,**self.fft_kw)
+        AY = fft.irfftn(ft_Ay,s=self.shape,overwrite_x=True,**self.fft_kw)
+        AZ = fft.irfftn(ft_Az,s=self.shape,overwrite_x=True,**self.fft_kw)
+        
+        if self.backend == 'cupy':
+            AX, AY, AZ = cp.asnumpy(AX), cp.asnumpy(AY), cp.asnumpy(AZ)
+        
+        return AX,AY,AZ,self.mesh_params
+
+def calculate_A_3D(MX,MY,MZ, mesh_params=None,n_pad=100,tik_filter=0.01,backend='numpy'):
     """ Input(3D (nx,ny,nz) array for each component of M) and return
     three 3D arrays of magnetic vector potential 
     
@@ -1525,72 +1805,58 @@ def calculate_A_3D(MX,MY,MZ, mesh_params=None,n_pad=100,tik_filter=0.01):
     projection to phase change this will make a difference. So the new
     mesh parameters are also returned
     
-    """
+    backend = 'cupy' does the padding, FFTs and k-space algebra on the GPU,
+    only copying the final float32 A arrays back to the host
+    
+    For repeated calls on arrays of the same shape, create an AFieldSolver
+    once and call its solve() method instead """
+    solver = AFieldSolver(np.shape(MX),mesh_params=mesh_params,n_pad=n_pad,tik_filter=tik_filter,backend=backend)
+    return solver.solve(MX,MY,MZ)
+
+def calculate_A_2D_projected(MX,MY,MZ,mesh_params=None,n_pad=100,tik_filter=0.01):
+    """ z-projection of the magnetic vector potential, equal to projecting
+    the output of calculate_A_3D along z but much cheaper
+    
+    Projecting along z picks out the kz = 0 plane of the 3D FT, so only a
+    2D FFT of the z-projected M is needed (n^2 log n rather than n^3 log n).
+    Returns three 2D arrays, padded in x and y, and the padded mesh parameters """
     if mesh_params == None:
         p1 = (0,0,0)
         sx,sy,sz = np.shape(MX)
         p2 = (sx,sy,sx)
         n = p2
+        mesh_params = [p1,p2,n]
     else:
         p1,p2,n = mesh_params
     
-    # zero pad M to avoid FT convolution wrap-around artefacts
-    mxpad = np.pad(MX,[(n_pad,n_pad),(n_pad,n_pad),(n_pad,n_pad)], mode='constant', constant_values=0)
-    mypad = np.pad(MY,[(n_pad,n_pad),(n_pad,n_pad),(n_pad,n_pad)], mode='constant', constant_values=0)
-    mzpad = np.pad(MZ,[(n_pad,n_pad),(n_pad,n_pad),(n_pad,n_pad)], mode='constant', constant_values=0)
-
-    # take 3D FT of M    
-    ft_mx = np.fft.fftn(mxpad)
-    ft_my = np.fft.fftn(mypad)
-    ft_mz = np.fft.fftn(mzpad)
-    
-    # Generate K values
-    resx = p2[0]/n[0] # resolution in m per px 
-    resy = p2[1]/n[1] # resolution in m per px 
-    resz = p2[2]/n[2] # resolution in m per px 
-
-    kx = np.fft.fftfreq(ft_mx.shape[0],d=resx)
-    ky = np.fft.fftfreq(ft_my.shape[0],d=resy)
-    kz = np.fft.fftfreq(ft_mz.shape[0],d=resz)
-    KX, KY, KZ = np.meshgrid(kx,ky,kz, indexing='ij') # Create a grid of coordinates
-    
     # vacuum permeability
     mu0 = 4*np.pi*1e-7
     
-    # Calculate 1/k^2 with Tikhanov filter
-    if tik_filter == 0:
-        K2_inv = np.nan_to_num(((KX**2+KY**2+KZ**2)**.5)**-2)
-    else:
-        K2_inv = ((KX**2+KY**2+KZ**2)**.5 + tik_filter*resx)**-2
-    
-    # M cross K
-    cross_x = ft_my*KZ - ft_mz*KY
-    cross_y = -ft_mx*KZ + ft_mz*KX
-    cross_z = -ft_my*KX + ft_mx*KY
+    resx = p2[0]/n[0] # resolution in m per px 
+    resy = p2[1]/n[1] # resolution in m per px 
     
-    # Calculate A(k)
-    ft_Ax = (-1j * mu0 * K2_inv) * cross_x
-    ft_Ay = (-1j * mu0 * K2_inv) * cross_y
-    ft_Az = (-1j * mu0 * K2_inv) * cross_z
+    # Project and pad M (float32, so the FFTs run in complex64)
+    ms = []
+    for M in (MX,MY,MZ):
+        m = project_along_z(M,mesh_params=mesh_params).astype(np.float32,copy=False)
+        ms.append(np.pad(m,[(n_pad,n_pad),(n_pad,n_pad)], mode='constant', constant_values=0))
+    shape = ms[0].shape
+    ft_mx, ft_my, ft_mz = [spfft.rfft2(m,workers=-1) for m in ms]
     
-    # Inverse fourier transform
-    Ax = np.fft.ifftn(ft_Ax)
-    AX = Ax.real
-    Ay = np.fft.ifftn(ft_Ay)
-    AY = Ay.real
-    Az = np.fft.ifftn(ft_Az)
-    AZ = Az.real
+    # K values in the kz = 0 plane (k-linear terms zeroed at Nyquist)
+    KX, KY, K2_inv = _k_grids_2d(shape,resx,resy,tik_filter*resx)
+    K2_inv = -1j * mu0 * K2_inv
     
-    # new mesh parameters (with padding)
-    n = (n[0]+2*n_pad,n[1]+2*n_pad,n[2]+2*n_pad)
-    p2 = (p2[0]+2*n_pad*resx,p2[1]+2*n_pad*resy,p2[2]+2*n_pad*resz)
-    mesh_params=(p1,p2,n)
+    # M cross K with kz = 0
+    AX = spfft.irfft2(K2_inv * (-ft_mz*KY),s=shape,workers=-1,overwrite_x=True)
+    AY = spfft.irfft2(K2_inv * (ft_mz*KX),s=shape,workers=-1,overwrite_x=True)
+    AZ = spfft.irfft2(K2_inv * (-ft_my*KX + ft_mx*KY),s=shape,workers=-1,overwrite_x=True)
     
-    AX=AX.astype(np.float32)
-    AY=AY.astype(np.float32)
-    AZ=AZ.astype(np.float32)
+    # new mesh parameters (with x/y padding)
+    n = (n[0]+2*n_pad,n[1]+2*n_pad,n[2])
+    p2 = (p2[0]+2*n_pad*resx,p2[1]+2*n_pad*resy,p2[2])
     
-    return AX,AY,AZ,mesh_params
+    return AX,AY,AZ,(p1,p2,n)
 
 def calculate_phase_AZ(AZ,mesh_params=None):
     if mesh_params == None:
@@ -1606,10 +1872,36 @@ def calculate_phase_AZ(AZ,mesh_params=None):
     phase = AZ_proj * -1* np.pi/constants.codata.value('mag. flux quantum') / (2*np.pi)
     return phase
 
-def calculate_phase_M_2D(MX,MY,MZ,mesh_params,n_pad=500,tik_filter=0.01,unpad=True):
+def _fast_pad(n):
+    """ Padding per side so that n+2*pad is a fast FFT length >= 2n """
+    size = spfft.next_fast_len(2*n,real=True)
+    while (size-n) % 2:
+        size = spfft.next_fast_len(size+1,real=True)
+    return (size-n)//2
+
+def calculate_phase_M_2D(MX,MY,MZ,mesh_params,n_pad=500,tik_filter=0.01,unpad=True,dtype=np.float32):
     """ Preffered method. Takes 3D MX,MY,MZ magnetisation arrays
     and calculates phase shift in rads in z direction.
-    First projects M from 3D to 2D which speeds up calculations """
+    First projects M from 3D to 2D which speeds up calculations
+    
+    n_pad = padding per side. None picks the smallest fast FFT size >= 2n
+    for each axis, which is much quicker but the phase kernel is long-range
+    so expect errors of tens of % compared to heavy padding
+    
+    dtype = real precision of the calculation (np.float32 runs the FFTs in
+    complex64, np.float64 in complex128) """
+    p1,p2,n=mesh_params
+    
+    # Project magnetisation array (scipy.fft keeps the precision of real input)
+    mx = project_along_z(MX,mesh_params=mesh_params).astype(dtype,copy=False)
+    my = project_along_z(MY,mesh_params=mesh_params).astype(dtype,copy=False)
+    
+    return phase_from_projected_M(mx,my,mesh_params,n_pad=n_pad,tik_filter=tik_filter,unpad=unpad)
+
+def phase_from_projected_M(mx,my,mesh_params,n_pad=500,tik_filter=0.01,unpad=True):
+    """ Second half of calculate_phase_M_2D, phase shift in rads from z-projected mx,my.
+    mx,my may be stacks (..., nx, ny) of projections, in which case the 2D FFTs
+    over the last two axes are done as one batched transform """
     p1,p2,n=mesh_params
     
     # J. Loudon et al, magnetic imaging, eq. 29
@@ -1618,49 +1910,45 @@ def calculate_phase_M_2D(MX,MY,MZ,mesh_params,n_pad=500,tik_filter=0.01,unpad=Tr
     # Define resolution from mesh parameters
     resx = p2[0]/n[0] # resolution in m per px 
     resy = p2[1]/n[1] # resolution in m per px 
-    resz = p2[2]/n[2] # resolution in m per px 
-    
-    # Project magnetisation array
-    mx = project_along_z(MX,mesh_params=mesh_params)
-    my = project_along_z(MY,mesh_params=mesh_params)
     
     # Take fourier transform of M
     # Padding necessary to stop Fourier convolution wraparound (spectral leakage)
-    if n_pad > 0:
-        mx = np.pad(mx,[(n_pad,n_pad),(n_pad,n_pad)], mode='constant', constant_values=0)
-        my = np.pad(my,[(n_pad,n_pad),(n_pad,n_pad)], mode='constant', constant_values=0)
+    if n_pad is None:
+        px, py = _fast_pad(mx.shape[-2]), _fast_pad(mx.shape[-1])
+    else:
+        px, py = n_pad, n_pad
+    pad = [(0,0)]*(mx.ndim-2) + [(px,px),(py,py)]
+    mx = np.pad(mx,pad, mode='constant', constant_values=0)
+    my = np.pad(my,pad, mode='constant', constant_values=0)
+    shape = mx.shape[-2:]
     
-    ft_mx = np.fft.fft2(mx)
-    ft_my = np.fft.fft2(my)
+    # Real input, so only ky >= 0 is needed
+    ft_mx = spfft.rfft2(mx,workers=-1)
+    ft_my = spfft.rfft2(my,workers=-1)
     
-    # Generate K values
-    kx = np.fft.fftfreq(n[0]+2*n_pad,d=resx)
-    ky = np.fft.fftfreq(n[1]+2*n_pad,d=resy)
-    KX, KY = np.meshgrid(kx,ky, indexing='ij') # Create a grid of coordinates
-    
-    # Filter to avoid division by 0
-    if tik_filter == 0:
-        K2_inv = np.nan_to_num(((KX**2+KY**2)**.5)**-2)
-    else:
-        K2_inv = ((KX**2+KY**2)**.5 + tik_filter*resx)**-2
+    # Generate K values and filtered 1/k^2 (cached between calls), with
+    # k-linear terms zeroed at Nyquist to get the same result from irfft2
+    KX, KY, K2_inv = _k_grids_2d(shape,resx,resy,tik_filter*resx,mx.dtype)
 
     # Take cross product (we only need z component)
     cross_z = (-ft_my*KX + ft_mx*KY)*K2_inv
     
     # Inverse fourier transform
-    phase = np.fft.ifft2(const*cross_z).real
+    phase = spfft.irfft2(cross_z.dtype.type(const)*cross_z,s=shape,workers=-1,overwrite_x=True)
     
     # Unpad
     if unpad == True:
-        if n_pad > 0:
-            phase=phase[n_pad:-n_pad,n_pad:-n_pad]
+        phase = phase[...,px:shape[0]-px,py:shape[1]-py]
     
     return phase
 
-def calculate_phase_M_3D(MX,MY,MZ,mesh_params,n_pad=100,tik_filter=0.01):
-    """ Slower than 2D but good for comparison. Takes 3D MX,MY,MZ magnetisation arrays
+def calculate_phase_M_3D(MX,MY,MZ,mesh_params,n_pad=100,tik_filter=0.01,dtype=np.float64):
+    """ Good for comparison with the 2D method. Takes 3D MX,MY,MZ magnetisation arrays
     and calculates phase shift in rads in z direction.
-    Calculations performed directly in 3D """
+    Uses the kz = 0 plane of the 3D FT (the FT of the z sum of M) rather than
+    projecting M first, and keeps the full-complex FFT
+    
+    dtype = real precision of the calculation (np.float32 for complex64 FFTs) """
     p1,p2,n=mesh_params
     
     # constant prefactor
@@ -1670,33 +1958,39 @@ def calculate_phase_M_3D(MX,MY,MZ,mesh_params,n_pad=100,tik_filter=0.01):
     resx = p2[0]/n[0] # resolution in m per px 
     resy = p2[1]/n[1] # resolution in m per px 
     resz = p2[2]/n[2] # resolution in m per px 
-    MX = np.pad(MX,[(n_pad,n_pad),(n_pad,n_pad),(n_pad,n_pad)], mode='constant', constant_values=0)
-    MY = np.pad(MY,[(n_pad,n_pad),(n_pad,n_pad),(n_pad,n_pad)], mode='constant', constant_values=0)
-    MZ = np.pad(MZ, [(n_pad,n_pad),(n_pad,n_pad),(n_pad,n_pad)], mode='constant', constant_values=0)
-    kx = np.fft.fftfreq(n[0]+2*n_pad,d=resx)
-    ky = np.fft.fftfreq(n[1]+2*n_pad,d=resy)
-    kz = np.fft.fftfreq(n[2]+2*n_pad,d=resz)
-    KX, KY, KZ = np.meshgrid(kx,ky,kz, indexing='ij') # Create a grid of coordinates
-    K2_inv = np.nan_to_num(((KX**2+KY**2+KZ**2)**.5+ tik_filter*resx)**-2)
-    
-    # Take 3D fourier transforms (only need x and y for cross-z)
-    ft_mx = np.fft.fftn(MX)
-    ft_my = np.fft.fftn(MY)
+    # Only the kz = 0 plane is used, and fftn(M)[:,:,0] == fft2(M.sum(axis=2)),
+    # so sum along z first and pad in x/y only
+    # (MZ does not enter the z component of M x k)
+    MX = np.pad(np.sum(MX,axis=2,dtype=dtype),[(n_pad,n_pad),(n_pad,n_pad)], mode='constant', constant_values=0)
+    MY = np.pad(np.sum(MY,axis=2,dtype=dtype),[(n_pad,n_pad),(n_pad,n_pad)], mode='constant', constant_values=0)
+    # k in the kz = 0 plane (cached between calls)
+    KX, KY, K2_inv = _k_grids_2d(MX.shape,resx,resy,tik_filter*resx,np.dtype(dtype),real=False)
+    
+    # Take fourier transforms of the z sums, giving the kz = 0 plane of the 3D FT
+    # (only need x and y for cross-z)
+    ft_mx = spfft.fft2(MX,workers=-1)
+    ft_my = spfft.fft2(MY,workers=-1)
     
     # take cross product
-    cross_z = (-ft_my*KX + ft_mx*KY) * K2_inv
-    
-    # extract central slice
-    slice_z = cross_z[:,:,0] * resz 
+    slice_z = (-ft_my*KX + ft_mx*KY) * K2_inv
+    slice_z *= slice_z.dtype.type(const*resz)
     
     # inverse fourier transform
-    phase = np.fft.ifft2(const*slice_z).real
+    phase = spfft.ifft2(slice_z,workers=-1,overwrite_x=True).real
     
     if n_pad > 0:
         phase = phase[n_pad:-n_pad,n_pad:-n_pad]
     
     return phase
 
+def _ifftshift_crop(a,n_pad):
+    """ Equivalent to ifftshift(a)[n_pad:-n_pad,n_pad:-n_pad] but gathers the cropped
+    region straight from the unshifted array, without a shifted full-size copy """
+    H, W = a.shape
+    rows = (np.arange(n_pad,H-n_pad) + H//2) % H
+    cols = (np.arange(n_pad,W-n_pad) + W//2) % W
+    return a[np.ix_(rows,cols)]
+
 def analytical_sphere(B0_T=1.6,r_m=50*1e-9,mesh_params=None,beta=-90,n_pad=100):
     """ Analytically calculates the phase change for a sphere (from Beleggia and Zhu 2003)"""
     import scipy
@@ -1715,23 +2009,25 @@ def analytical_sphere(B0_T=1.6,r_m=50*1e-9,mesh_params=None,beta=-90,n_pad=100):
     resx = p2[0]/n[0] # resolution in m per px 
     resy = p2[1]/n[1] # resolution in m per px 
     
-    kx = np.fft.fftfreq(n[0]+2*n_pad,d=resx)#/(2*np.pi))
-    ky = np.fft.fftfreq(n[1]+2*n_pad,d=resy)#/(2*np.pi))
+    kx = spfft.fftfreq(n[0]+2*n_pad,d=resx)#/(2*np.pi))
+    ky = spfft.fftfreq(n[1]+2*n_pad,d=resy)#/(2*np.pi))
     KX, KY = np.meshgrid(kx,ky)#,indexing='ij') # Create a grid of coordinates
     
-    # Calculate 1/k^2 with Tikhanov filter
-    K3_inv = np.nan_to_num(((KX**2+KY**2)**.5)**-3)
-    K =(KX**2+KY**2)**.5
+    # Calculate 1/k^3 in place from |k| (0 at k = 0, where the numerator vanishes)
+    K = np.hypot(KX,KY)
+    K3_inv = K*K
+    K3_inv *= K
+    K3_inv[0,0] = np.inf
+    np.reciprocal(K3_inv,out=K3_inv)
 
     #The normalized sinc function is the Fourier transform of the rectangular function with no scaling. np default is normalised
     phase_ft = const * (KY*np.cos(beta*np.pi/180) - KX*np.sin(beta*np.pi/180)) * K3_inv \
                         * scipy.special.spherical_jn(1,r_m*(2*np.pi)*K) / (resx*resy)
     
-    phase = np.fft.ifft2(phase_ft).real 
-    
-    phase = np.fft.ifftshift(phase) 
+    phase = spfft.ifft2(phase_ft,workers=-1,overwrite_x=True).real 
     
-    phase = phase[n_pad:-n_pad,n_pad:-n_pad]
+    # shift zero to the centre and remove padding in one step
+    phase = _ifftshift_crop(phase,n_pad)
     
     return phase
 
@@ -1753,27 +2049,131 @@ def analytical_rectangle(B0_T=1.6,lx_m=200*1e-9,ly_m=140*1e-9,lz_m=20*1e-9,mesh_
     resx = p2[0]/n[0] # resolution in m per px 
     resy = p2[1]/n[1] # resolution in m per px 
 
-    kx = np.fft.fftfreq(n[0]+2*n_pad,d=resx)
-    ky = np.fft.fftfreq(n[1]+2*n_pad,d=resy)
+    kx = spfft.fftfreq(n[0]+2*n_pad,d=resx)
+    ky = spfft.fftfreq(n[1]+2*n_pad,d=resy)
     KX, KY = np.meshgrid(kx,ky,indexing='ij') # Create a grid of coordinates
     #KX,KY=KX*(2*np.pi),KY*(2*np.pi)
     
-    # Calculate 1/k^2 with Tikhanov filter
-    K2_inv = np.nan_to_num(((KX**2+KY**2)**.5)**-2)
+    # Calculate 1/k^2 in place (no Tikhanov filter)
+    K2_inv = _k2_inv(KX*KX + KY*KY, 0)
 
     #The normalized sinc function is the Fourier transform of the rectangular function with no scaling. np default is normalised
     phase_ft = const * K2_inv * (KY*np.cos(beta*np.pi/180) - KX*np.sin(beta*np.pi/180)) * np.sinc(lx_m*KX) * np.sinc(ly_m*KY) / (resx*resy)
     
-    phase = np.fft.ifft2(phase_ft).real
+    phase = spfft.ifft2(phase_ft,workers=-1,overwrite_x=True).real
     
-    phase = np.fft.ifftshift(phase) / (2*np.pi)
-    
-    if n_pad>0:
-        phase = phase[n_pad:-n_pad,n_pad:-n_pad]
+    # shift zero to the centre and remove padding in one step
+    phase = _ifftshift_crop(phase,n_pad)
+    phase /= 2*np.pi
     
     return phase
 
-def linsupPhi(mx=1.0, my=1.0, mz=1.0, Dshp=None, theta_x=0.0, theta_y=0.0, pre_B=1.0, pre_E=1, v=1, multiproc=True):
+@njit(parallel=True,fastmath=True,cache=True)
+def _exp_sum_kernel(acc, zz, yy, xx, ky, kx, j_n, i_n, my_n, mx_n, Sy_re, Sy_im, Sx_re, Sx_im):
+    """ Kernel for exp_sum. The voxels are split into acc.shape[0] chunks, one per
+    thread, and each chunk sums into its own slab acc[c] = (e_re,e_im,m_re,m_im),
+    so threads never write to shared memory. The slabs are reduced by the caller.
+    KY only varies along y and KX along x, so exp(-i(ky*j + kx*i)) is the outer
+    product of two 1D phasors: dimy+dimx sin/cos per voxel instead of dimy*dimx """
+    nch, nv = acc.shape[0], zz.shape[0]
+    for ic in prange(nch):
+        e_re, e_im, m_re, m_im = acc[ic,0], acc[ic,1], acc[ic,2], acc[ic,3]
+        cy, sy = np.empty(ky.shape[0]), np.empty(ky.shape[0])
+        cx, sx = np.empty(kx.shape[0]), np.empty(kx.shape[0])
+        for n in range(ic*nv//nch, (ic+1)*nv//nch):
+            z, y, x = zz[n], yy[n], xx[n]
+            jn, in_ = j_n[z,y,x], i_n[z,y,x]
+            myn, mxn = my_n[z,y,x], mx_n[z,y,x]
+            for iy in range(ky.shape[0]):
+                cy[iy], sy[iy] = np.cos(-ky[iy]*jn), np.sin(-ky[iy]*jn)
+            for ix in range(kx.shape[0]):
+                cx[ix], sx[ix] = np.cos(-kx[ix]*in_), np.sin(-kx[ix]*in_)
+            for iy in range(ky.shape[0]):
+                for ix in range(kx.shape[0]):
+                    c = cy[iy]*cx[ix] - sy[iy]*sx[ix]
+                    s = sy[iy]*cx[ix] + cy[iy]*sx[ix]
+                    # (c + i s) * (fr + i fi), with f = my*Sx - mx*Sy
+                    fr = myn*Sx_re[iy,ix] - mxn*Sy_re[iy,ix]
+                    fi = myn*Sx_im[iy,ix] - mxn*Sy_im[iy,ix]
+                    e_re[iy,ix] += c
+                    e_im[iy,ix] += s
+                    m_re[iy,ix] += c*fr - s*fi
+                    m_im[iy,ix] += c*fi + s*fr
+
+def exp_sum(mphi_k, ephi_k, zz, yy, xx, KY, KX, j_n, i_n, my_n, mx_n, Sy, Sx):
+    """ Compiled voxel sum for linsupPhi, adds exp(-i(KY*j_n + KX*i_n)) for
+    every voxel (zz,yy,xx) to ephi_k (and weighted by the magnetisation to mphi_k).
+    Each thread accumulates its share of voxels into private real/imaginary
+    float64 slabs (vectorisable, no contention), which are summed at the end """
+    split = lambda a: (np.ascontiguousarray(a.real,dtype=np.float64),
+                       np.ascontiguousarray(a.imag,dtype=np.float64))
+    nch = min(get_num_threads(),len(zz)) if has_numba else 1
+    acc = np.zeros((max(nch,1),4)+np.shape(KX))
+    ky, kx = np.ascontiguousarray(KY[:,0]), np.ascontiguousarray(KX[0,:])
+    _exp_sum_kernel(acc, zz, yy, xx, ky, kx, j_n, i_n, my_n, mx_n, *split(Sy), *split(Sx))
+    e_re, e_im, m_re, m_im = acc.sum(axis=0)
+    return ephi_k + (e_re + 1j*e_im), mphi_k + (m_re + 1j*m_im)
+
+# CUDA version of _exp_sum_kernel: one thread per k point (kx,ky and the S
+# filters held in registers), looping over voxels which are staged through
+# shared memory in tiles of one block (256 voxels, 4 values each)
+_exp_sum_cuda = r'''
+extern "C" __global__
+void exp_sum(const double* KY, const double* KX,
+             const double* Sx_re, const double* Sx_im,
+             const double* Sy_re, const double* Sy_im,
+             const double* vox, const int nvox, const int nk, double* acc)
+{
+    __shared__ double tile[256*4];
+    int k = blockIdx.x*blockDim.x + threadIdx.x;
+    double ky = 0, kx = 0, sxr = 0, sxi = 0, syr = 0, syi = 0;
+    if (k < nk) {
+        ky = KY[k]; kx = KX[k];
+        sxr = Sx_re[k]; sxi = Sx_im[k]; syr = Sy_re[k]; syi = Sy_im[k];
+    }
+    double er = 0, ei = 0, mr = 0, mi = 0;
+    for (int start = 0; start < nvox; start += 256) {
+        int v = start + threadIdx.x;
+        if (v < nvox) {
+            for (int q = 0; q < 4; q++) tile[4*threadIdx.x+q] = vox[4*v+q];
+        }
+        __syncthreads();
+        int nt = min(256, nvox-start);
+        if (k < nk) {
+            for (int t = 0; t < nt; t++) {
+                // vox rows are (j_n, i_n, my_n, mx_n)
+                double s, c;
+                sincos(-(ky*tile[4*t] + kx*tile[4*t+1]), &s, &c);
+                double fr = tile[4*t+2]*sxr - tile[4*t+3]*syr;
+                double fi = tile[4*t+2]*sxi - tile[4*t+3]*syi;
+                er += c;
+                ei += s;
+                mr += c*fr - s*fi;
+                mi += c*fi + s*fr;
+            }
+        }
+        __syncthreads();
+    }
+    if (k < nk) {
+        acc[k] = er; acc[nk+k] = ei; acc[2*nk+k] = mr; acc[3*nk+k] = mi;
+    }
+}
+'''
+
+def exp_sum_cupy(mphi_k, ephi_k, zz, yy, xx, KY, KX, j_n, i_n, my_n, mx_n, Sy, Sx):
+    """ As exp_sum, but computed on the GPU with a CuPy RawKernel """
+    vox = cp.asarray(np.stack([j_n[zz,yy,xx],i_n[zz,yy,xx],my_n[zz,yy,xx],mx_n[zz,yy,xx]],axis=1),dtype=cp.float64)
+    to_gpu = lambda a: cp.ascontiguousarray(cp.asarray(a,dtype=cp.float64))
+    nk = KX.size
+    acc = cp.empty((4,nk),dtype=cp.float64)
+    kernel = cp.RawKernel(_exp_sum_cuda,'exp_sum')
+    kernel(((nk+255)//256,),(256,),
+           (to_gpu(KY),to_gpu(KX),to_gpu(Sx.real),to_gpu(Sx.imag),to_gpu(Sy.real),to_gpu(Sy.imag),
+            vox,np.int32(len(vox)),np.int32(nk),acc))
+    e_re, e_im, m_re, m_im = cp.asnumpy(acc).reshape((4,)+np.shape(KX))
+    return ephi_k + (e_re + 1j*e_im), mphi_k + (m_re + 1j*m_im)
+
+def linsupPhi(mx=1.0, my=1.0, mz=1.0, Dshp=None, theta_x=0.0, theta_y=0.0, pre_B=1.0, pre_E=1, v=1, multiproc=True, backend='numpy'):
     """Applies linear superposition principle for 3D reconstruction of magnetic and electrostatic phase shifts.
     This function will take 3D arrays with Mx, My and Mz components of the 
     magnetization, the Dshp array consisting of the shape function for the 
@@ -1800,6 +2200,8 @@ def linsupPhi(mx=1.0, my=1.0, mz=1.0, Dshp=None, theta_x=0.0, theta_y=0.0, pre_B
         v (int): Verbosity. v >= 1 will print status and progress when running
             without numba. v=0 will suppress all prints. 
         mp (bool): Whether or not to implement multiprocessing. 
+        backend (str): 'cupy' runs the voxel sum on the GPU (needs cupy),
+            otherwise it runs on the cpu as set by multiproc. 
     Returns: 
         tuple: Tuple of length 2: (ephi, mphi). Where ephi and mphi are 2D numpy
         arrays of the electrostatic and magnetic phase shifts respectively. 
@@ -1832,9 +2234,8 @@ def linsupPhi(mx=1.0, my=1.0, mz=1.0, Dshp=None, theta_x=0.0, theta_y=0.0, pre_B
     # thickness == 0 
     if Dshp is None: 
         Dshp = np.ones(mx.shape)
-    # exclude indices where thickness is 0, compile into list of ((z1,y1,x1), (z2,y2...
+    # exclude indices where thickness is 0, kept as flat index arrays zz, yy, xx
     zz, yy, xx = np.where(Dshp != 0)
-    inds = np.dstack((zz,yy,xx)).squeeze()
 
     # Compute the rotation angles
     st = np.sin(np.deg2rad(theta_x))
@@ -1845,50 +2246,75 @@ def linsupPhi(mx=1.0, my=1.0, mz=1.0, Dshp=None, theta_x=0.0, theta_y=0.0, pre_B
     x = np.arange(dimx) - dx2
     y = np.arange(dimy) - dy2
     z = np.arange(dimz) - dz2
-    Z,Y,X = np.meshgrid(z,y,x, indexing='ij') # grid of actual positions (centered on 0)
+    Z,Y,X = z[:,None,None], y[None,:,None], x[None,None,:] # broadcast positions (centered on 0)
 
     # compute the rotated values; 
     # here we apply rotation about X first, then about Y
-    i_n = Z*sg*ct + Y*sg*st + X*cg
-    j_n = Y*ct - Z*st
+    # (scalar factors combined first, so each sum makes one full-volume array)
+    i_n = (Z*(sg*ct) + Y*(sg*st)) + X*cg
+    j_n = np.broadcast_to(Y*ct - Z*st, mx.shape) # independent of x, so a (z,y) view
 
-    mx_n = mx*cg + my*sg*st + mz*sg*ct
-    my_n = my*ct - mz*st
+    mx_n = mx*cg
+    mx_n += my*(sg*st)
+    mx_n += mz*(sg*ct)
+    my_n = my*ct
+    my_n -= mz*st
 
     # setup 
     mphi_k = np.zeros(KK.shape,dtype=complex)
     ephi_k = np.zeros(KK.shape,dtype=complex)
 
-    nelems = np.shape(inds)[0]
+    nelems = len(zz)
     stime = time.time()
     vprint(f'Beginning phase calculation for {nelems:g} voxels.')
-    if multiproc:
+    if backend == 'cupy':
+        vprint("Running on the GPU with cupy.")
+        ephi_k, mphi_k = exp_sum_cupy(mphi_k, ephi_k, zz, yy, xx, KY, KX, j_n, i_n, my_n, mx_n, Sy, Sx)
+
+    elif multiproc:
         vprint("Running in parallel with numba.")
-        ephi_k, mphi_k = exp_sum(mphi_k, ephi_k, inds, KY, KX, j_n, i_n, my_n, mx_n, Sy, Sx)        
+        ephi_k, mphi_k = exp_sum(mphi_k, ephi_k, zz, yy, xx, KY, KX, j_n, i_n, my_n, mx_n, Sy, Sx)
 
     else:
         vprint("Running on 1 cpu.")
         otime = time.time()
         vprint('0.00%', end=' .. ')
-        cc = -1
-        for ind in inds:
-            ind = tuple(ind)
-            cc += 1
+        # real scratch buffers reused for every voxel; Sx, Sy are purely imaginary so
+        # exp(-i ph) * 1j*s = s*sin(ph) + 1j*s*cos(ph)
+        sx, sy = Sx.imag, Sy.imag
+        ph, c, sn, sb, tmp = (np.empty_like(KY) for _ in range(5))
+        e_re, e_im, m_re, m_im = (np.zeros_like(KY) for _ in range(4))
+        # per-voxel values gathered once, so the loop runs over plain floats
+        vox = zip(j_n[zz,yy,xx].tolist(),i_n[zz,yy,xx].tolist(),my_n[zz,yy,xx].tolist(),mx_n[zz,yy,xx].tolist())
+        for cc, (jn, in_, myn, mxn) in enumerate(vox):
             if time.time() - otime >= 15:
                 vprint(f'{cc/nelems*100:.2f}%', end=' .. ')
                 otime = time.time()
             # compute the expontential summation
-            sum_term = np.exp(-1j * (KY*j_n[ind] + KX*i_n[ind]))
-            ephi_k += sum_term 
-            mphi_k += sum_term * (my_n[ind]*Sx - mx_n[ind]*Sy)
+            np.multiply(KY,jn,out=ph)
+            np.multiply(KX,in_,out=tmp)
+            ph += tmp
+            np.cos(ph,out=c)
+            np.sin(ph,out=sn)
+            np.multiply(sx,myn,out=sb)
+            np.multiply(sy,mxn,out=tmp)
+            sb -= tmp
+            e_re += c
+            e_im -= sn
+            np.multiply(sb,sn,out=tmp)
+            m_re += tmp
+            np.multiply(sb,c,out=tmp)
+            m_im += tmp
+        ephi_k += e_re + 1j*e_im
+        mphi_k += m_re + 1j*m_im
         vprint('100.0%')
 
     vprint(f"total time: {time.time()-stime:.5g} sec, {(time.time()-stime)/nelems:.5g} sec/voxel.")
     #Now we have the phases in K-space. We convert to real space and return
     ephi_k[zeros] = 0.0
     mphi_k[zeros] = 0.0
-    ephi = (np.fft.ifftshift(np.fft.ifftn(np.fft.ifftshift(ephi_k)))).real*pre_E
-    mphi = (np.fft.ifftshift(np.fft.ifftn(np.fft.ifftshift(mphi_k)))).real*pre_B
+    ephi = (spfft.ifftshift(spfft.ifftn(spfft.ifftshift(ephi_k),workers=-1,overwrite_x=True))).real*pre_E
+    mphi = (spfft.ifftshift(spfft.ifftn(spfft.ifftshift(mphi_k),workers=-1,overwrite_x=True))).real*pre_B
 
     return (ephi,mphi)
 
@@ -1930,15 +2356,18 @@ def calculate_B_from_A(AX,AY,AZ,mesh_params=None):
     resy = p2[1]/n[1] # resolution in m per px 
     resz = p2[2]/n[2] # resolution in m per px 
     
-    BX = np.gradient(AZ,resy)[1] - np.gradient(AY,resz)[2]
-    BY = np.gradient(AX,resz)[2] - np.gradient(AZ,resx)[0]
-    BZ = np.gradient(AY,resx)[0] - np.gradient(AX,resy)[1]
+    # B is returned as float32, so work in float32 (no copy if A already is)
+    AX, AY, AZ = (np.asarray(A,dtype=np.float32) for A in (AX,AY,AZ))
+    
+    # only the needed derivative of each component
+    BX = np.gradient(AZ,resy,axis=1) - np.gradient(AY,resz,axis=2)
+    BY = np.gradient(AX,resz,axis=2) - np.gradient(AZ,resx,axis=0)
+    BZ = np.gradient(AY,resx,axis=0) - np.gradient(AX,resy,axis=1)
     
-    BX=BX.astype(np.float32)
-    BY=BY.astype(np.float32)
-    BZ=BZ.astype(np.float32)
+    for B in (BX,BY,BZ):
+        B /= 2*np.pi
         
-    return BX/(2*np.pi),BY/(2*np.pi),BZ/(2*np.pi)
+    return BX,BY,BZ
 
 def calculate_B_from_phase(phase_B,mesh_params=None):
     if mesh_params == None:
@@ -2006,14 +2435,11 @@ def plot_colorwheel(alpha=1,rot=0,flip= False, ax=None,rad=0.5,clip=48,shape=200
     # Create coordinate space
     x = np.linspace(-scale/2,scale/2,shape)
     y = x
-    X,Y = np.meshgrid(x,y)
+    xx, yy = x[:,None], y[None,:] # broadcast so [ix,iy] -> (x[ix],y[iy])
 
     # Map theta values onto coordinate space 
-    thetas = np.ones_like(X)*0
-    for ix, xx in enumerate(x):
-        for iy, yy in enumerate(y):
-            # shifting will shift the centre of divergence
-            thetas[ix,iy] = cart2pol((xx+shift_centre[0]*scale),(yy+shift_centre[1]*scale))[1]
+    # shifting will shift the centre of divergence
+    thetas = cart2pol((xx+shift_centre[0]*scale),(yy+shift_centre[1]*scale))[1]
 
     # Plot hsv colormap of angles
     if flip == False:
@@ -2025,12 +2451,8 @@ def plot_colorwheel(alpha=1,rot=0,flip= False, ax=None,rad=0.5,clip=48,shape=200
     my_cmap = alpha_cmap()
     
     # Map circle radii onto xy coordinate space
-    circ = np.ones_like(X)*0
-    for ix, xx in enumerate(x):
-        for iy, yy in enumerate(y):
-            if (xx+shift_centre[1]*scale)**2 + (yy-shift_centre[0]*scale)**2 < (rad*scale)**2:
-                #print(xx,shift_centre[0])
-                circ[ix,iy] = cart2pol((xx+shift_centre[1]*scale),(yy-shift_centre[0]*scale))[0]
+    cx, cy = (xx+shift_centre[1]*scale), (yy-shift_centre[0]*scale)
+    circ = np.where(cx**2 + cy**2 < (rad*scale)**2, cart2pol(cx,cy)[0], 0)
 
     # Plot circle
     im2 = plt.imshow(circ, cmap=my_cmap,alpha=alpha,extent=extent,zorder=2)
@@ -2135,21 +2557,18 @@ def shift_angles(vals,angle=None):
         return vals
     
     newvals = vals+angle
-    for i,vv in enumerate(newvals):
-        for j,v in enumerate(vv):
-            if v > np.pi:
-                newvals[i,j] = v - 2*np.pi
-            if v < -np.pi:
-                newvals[i,j] = v + 2*np.pi
+    # single wrap back into range (keeps +/-pi exactly, unlike a modulo)
+    newvals = np.where(newvals > np.pi, newvals - 2*np.pi,
+                       np.where(newvals < -np.pi, newvals + 2*np.pi, newvals))
             
     return newvals
 
 #### from magnetic_reconstruction
-def generate_phase_data(MX,MY,MZ,angles,mesh_params=None,n_pad=500,unpad=False):
+def generate_phase_data(MX,MY,MZ,angles,mesh_params=None,n_pad=500,unpad=False,batch=8):
     """ Returns phase projections for given M and angles
-    in order [x, i_tilt, y] """
+    in order [x, i_tilt, y]
+    batch = number of projections whose FFTs are done together (bounds memory) """
     # Initialise parameters
-    phase_projs = []
     if mesh_params == None:
         p1 = (0,0,0)
         s = np.shape(MX)
@@ -2157,21 +2576,26 @@ def generate_phase_data(MX,MY,MZ,angles,mesh_params=None,n_pad=500,unpad=False):
         n = p2
         mesh_params = [p1,p2,n]
     
-    # Loop through projection angles
-    for i in range(len(angles)):
+    # Rotate and project M for every angle
+    n_ang = len(angles)
+    mxs = np.empty((n_ang,)+np.shape(MX)[:2],dtype=np.float32)
+    mys = np.empty_like(mxs)
+    for i in range(n_ang):
         ax,ay,az = angles[i]
-        #rotate M
         MXr,MYr,MZr = rotate_magnetisation(MX,MY,MZ,ax,ay,az)
-        #calculate phase
-        phase = calculate_phase_M_2D(MXr,MYr,MZr,mesh_params=mesh_params,n_pad=n_pad,unpad=unpad)
-        phase = np.flipud(phase.T)
-
-        phase_projs.append(phase)            
+        project_along_z(MXr,mesh_params=mesh_params,out=mxs[i])
+        project_along_z(MYr,mesh_params=mesh_params,out=mys[i])
     
-    # Prepare projections for reconstruction
-    phase_projs = np.transpose(phase_projs,axes=[1,0,2]) # reshape so proj is middle column
-    phase_projs=phase_projs.astype(np.float32)
-    return np.array(phase_projs)
+    # Calculate phases in batches of projections
+    phase_projs = None
+    for i in range(0,n_ang,batch):
+        phase = phase_from_projected_M(mxs[i:i+batch],mys[i:i+batch],mesh_params,n_pad=n_pad,unpad=unpad)
+        if phase_projs is None:
+            # [x, i_tilt, y] with each projection flipud(phase.T)
+            phase_projs = np.empty((phase.shape[2],n_ang,phase.shape[1]),dtype=np.float32)
+        phase_projs[:,i:i+batch,:] = phase.transpose(2,0,1)[::-1]
+    
+    return phase_projs
 
 def rotate_magnetisation(U,V,W,ax=0,ay=0,az=0):
     """ 
@@ -2211,17 +2635,7 @@ def rotate_magnetisation(U,V,W,ax=0,ay=0,az=0):
 
 def grid_to_coor(U,V,W):
     """ Convert gridded 3D data (3,n,n,n) into coordinates (n^3, 3) """
-    coor_flat = []
-    nx = np.shape(U)[0]
-    ny = np.shape(U)[1]
-    nz = np.shape(U)[2]
-    for ix in range(nx):
-        for iy in range(ny):
-            for iz in range(nz):
-                x = U[ix,iy,iz]
-                y = V[ix,iy,iz]
-                z = W[ix,iy,iz]
-                coor_flat.append([x,y,z])
+    coor_flat = np.stack((U,V,W),axis=-1).reshape(-1,3)
                 
     return coor_flat
 
@@ -2232,12 +2646,8 @@ def coor_to_grid(coor_flat,shape=None):
         shape = (n,n,n)
     nx,ny,nz = shape
     
-    x = np.take(coor_flat,0,axis=1)
-    y = np.take(coor_flat,1,axis=1)
-    z = np.take(coor_flat,2,axis=1)
-    U = x.reshape((nx,ny,nz))
-    V = y.reshape((nx,ny,nz))
-    W = z.reshape((nx,ny,nz))
+    # One copy into (3,nx,ny,nz) so each component is contiguous
+    U, V, W = np.ascontiguousarray(np.moveaxis(np.reshape(coor_flat,(nx,ny,nz,3)),-1,0))
 
     return U, V, W
 
@@ -2248,11 +2658,11 @@ def rotate_vector(coor_flat,ax,ay,az):
     # Get rotation matrix
     mrot = rotation_matrix(ax,ay,az)    
 
-    coor_flat_r = np.zeros_like(coor_flat)
-    
-    # Apply rotation matrix to each M vector
-    for i,M in enumerate(coor_flat):
-        coor_flat_r[i] = mrot.dot(M)
+    # Apply rotation matrix to every M vector in one matrix product
+    # (float32 input stays float32, anything else is promoted to at least float32)
+    coor_flat = np.asarray(coor_flat)
+    dtype = np.result_type(coor_flat.dtype,np.float32)
+    coor_flat_r = coor_flat.astype(dtype,copy=False) @ mrot.T.astype(dtype)
     
     return coor_flat_r
 
@@ -2280,32 +2690,15 @@ def dual_axis_B_generation(pxs,pys,mesh_params):
     x_res = x_size/n[0]
     
     b_const = (constants.codata.value('mag. flux quantum')/(np.pi))
-    bxs = []
-    # calculate b component at each tilt
-    for i in range(np.shape(pxs)[1]):
-        p=pxs[:,i,:]
-        # calculate_B_from_phase assumes input is ordered in the wierd way (i.e. flip.T)
-        # but pxs/pys are somehow in the correct orientation, so we need to put them back for this to work
-        # since gradient[0] gives the column gradient and [1] gives the row, so we'll get an incorrect answer
-        #p = np.flipud(p).T
-        
-        # minus not needed as it goes bottom to top instead of top to bottom
-        bx = b_const*np.gradient(p,x_res)[0]
-        #_,bx,_ = ma.calculate_B_from_phase(p,mesh_params=mesh_params)
-        bxs.append(bx)
-    
-    bys = []
-    # calculate b component at each tilt
-    for i in range(np.shape(pys)[1]):
-        p=pys[:,i,:]
-        #p = np.flipud(p).T
-        by = b_const*np.gradient(p,x_res)[1]
-        #_,_,by = ma.calculate_B_from_phase(p,mesh_params=mesh_params)
-        bys.append(by)
-    
-    # reorder for tomo
-    bxs = np.transpose(bxs,axes=[1,0,2])
-    bys = np.transpose(bys,axes=[1,0,2])
+    # calculate b component at every tilt at once (tilt is the middle column,
+    # so the derivatives of each 2D image p = pxs[:,i,:] are along axes 0 and 2)
+    # calculate_B_from_phase assumes input is ordered in the wierd way (i.e. flip.T)
+    # but pxs/pys are somehow in the correct orientation, so we need to put them back for this to work
+    # since gradient[0] gives the column gradient and [1] gives the row, so we'll get an incorrect answer
+    
+    # minus not needed as it goes bottom to top instead of top to bottom
+    bxs = b_const*np.gradient(pxs,x_res,axis=0)
+    bys = b_const*np.gradient(pys,x_res,axis=2)
     
     return bxs,bys
 
@@ -2340,20 +2733,11 @@ def dual_axis_reconstruction(xdata,ydata,axs,ays,mesh_params,algorithm = 'SIRT3D
 
 def dual_axis_bz_from_bxby(bx,by):
     #dz = -1*(np.gradient(bx)[0]+np.gradient(by)[1])
-    bz = []
-    old=0
-    for i in range(np.shape(bx)[2]):
-        dbx = bx[:,:,i]
-        dby = by[:,:,i]
-        dbz = -1*(np.gradient(dbx)[0]+np.gradient(dby)[1])
-        cum = dbz+old
-        bz.append(cum)
-        old=cum    
+    # in-plane gradients of every slice at once, then integrate along z
+    dbz = -1*(np.gradient(bx,axis=0)+np.gradient(by,axis=1))
     #bz -= np.mean(bz)
     #removed the minus
-    bz = np.array(bz)
-    
-    bz = np.transpose(bz,axes=[1,2,0])
+    bz = np.cumsum(dbz,axis=2)
     return bz
 
 def plot_3d_B_slice(bx,by,bz,i_slice=None,mesh_params=None, ax=None,s=5,scale=7,mag_res=0.1, quiver=True, cbar=False,B_contour=True,phase=None,phase_res=np.pi/50):
@@ -2379,12 +2763,8 @@ def plot_3d_B_slice(bx,by,bz,i_slice=None,mesh_params=None, ax=None,s=5,scale=7,
     if type(i_slice) is type(None):
         i_slice=int(np.shape(bz)[2]/2)
         
-    bx=copy.deepcopy(bx)
-    by=copy.deepcopy(by)
-    bz=copy.deepcopy(bz)
-        
-    bmax = np.max((bx**2+by**2+bz**2)**0.5)
-    mag_B = ((bx**2+by**2)**0.5)[:,:,i_slice]
+    # slices are only read below, so no copies of the inputs are needed
+    bmax = np.sqrt(np.max(bx*bx+by*by+bz*bz))
     bx=bx[:,:,i_slice]
     by=by[:,:,i_slice]
     bz=bz[:,:,i_slice]
@@ -2472,10 +2852,22 @@ def CC(A,B):
     denom = ((N*np.sum(A**2)-np.sum(A)**2)*(N*np.sum(B**2)-np.sum(B)**2))**0.5
     return (num/denom)
 
+@njit(parallel=True,cache=True)
+def _maape_kernel(a,b):
+    """ Sum of arctan(|a-b|/|a|) over flat arrays a, b in a single pass """
+    s = 0.0
+    for i in prange(a.shape[0]):
+        s += math.atan2(abs(a[i]-b[i]),abs(a[i]))
+    return s
+
 def MAAPE(A,B):
     """ A = ground truth, B = reconstruction, 0 good, 1 bad"""
     N = np.shape(A)[0]*np.shape(A)[1]*np.shape(A)[2]
-    maape = 1/N*np.sum(np.arctan2(abs((A-B)),abs(A)))
+    if has_numba:
+        # fused, no full-size temporaries
+        maape = _maape_kernel(np.ravel(A),np.ravel(B))/N
+    else:
+        maape = 1/N*np.sum(np.arctan2(abs((A-B)),abs(A)))
     return maape
 
 def test_metric(A,B,fun):
@@ -2493,6 +2885,7 @@ def check_memory(g,d):
     pass in globals() and dir() so it works
     """
     import os
+    import sys
     import psutil
     import inspect
     print('--- RAM usage / GB ---')
@@ -2504,9 +2897,8 @@ def check_memory(g,d):
     # These are the usual ipython objects, including this one you are creating
     ipython_vars = ['In', 'Out', 'exit', 'quit', 'get_ipython', 'ipython_vars']
 
-    # Get a sorted list of the objects and their sizes
-    mems = sorted([(x, sys.getsizeof(g.get(x))) for x in d], key=lambda x: x[1], reverse=True)
-    vals = np.sum(np.array(mems)[:,1].astype('float32'))/1e9
+    # Total size of the objects (only the sum is reported, so no sort or array needed)
+    vals = sum(sys.getsizeof(g.get(x)) for x in d)/1e9
     print('Local:\t %.3f' %vals)
     
 def plot_B_series(bx,by,bz,slices=None):
@@ -2519,52 +2911,38 @@ def plot_B_series(bx,by,bz,slices=None):
         
     plt.tight_layout()
     
-def generate_A_projection(AX,AY,AZ,angles,mesh_params=None,unpad=False,reorient = False):
+def generate_A_projection(AX,AY,AZ,angles,mesh_params=None,unpad=False,reorient = False,mode='ndimage'):
     """ Returns A projections for given angles
-    in order [x, i_tilt, y] """
+    in order [x, i_tilt, y] 
+    mode = 'astra' forward projects on the GPU with generate_A_projection_fast
+    (whose output is always oriented as with reorient = True) """
     # Initialise parameters
-    ax_projs = []
-    ay_projs = []
-    az_projs = []
     if mesh_params == None:
         p1 = (0,0,0)
-        s = np.shape(MX)
+        s = np.shape(AX)
         p2 = (s[0],s[1],s[2])
         n = p2
         mesh_params = [p1,p2,n]
     
+    if mode == 'astra':
+        return generate_A_projection_fast(AX,AY,AZ,angles,mesh_params=mesh_params,unpad=unpad,reorient=True)
+    
+    # Projections written straight into astra's layout (proj is middle column)
+    nx,ny,nz = np.shape(AX)
+    shape = (ny,len(angles),nx) if reorient == True else (nx,len(angles),ny)
+    ax_projs, ay_projs, az_projs = (np.empty(shape,dtype=np.float32) for _ in range(3))
+    
     # Loop through projection angles
     for i in range(len(angles)):
         ax,ay,az = angles[i]
-        #rotate A
-        AXr = rotate_bulk(AX,ax,ay,az)
-        AYr = rotate_bulk(AY,ax,ay,az)
-        AZr = rotate_bulk(AZ,ax,ay,az)
-        ax_proj = project_along_z(AXr,mesh_params=mesh_params)
-        ay_proj = project_along_z(AYr,mesh_params=mesh_params)
-        az_proj = project_along_z(AZr,mesh_params=mesh_params)
-        
-        # reorient to match phase_projs
-        if reorient == True:
-            ax_proj = np.flipud(ax_proj.T)
-            ay_proj = np.flipud(ay_proj.T)
-            az_proj = np.flipud(az_proj.T)
-        
-        
-        #calculate phase
-        ax_projs.append(ax_proj)
-        ay_projs.append(ay_proj)
-        az_projs.append(az_proj)
-    
-    # Prepare projections for reconstruction
-    ax_projs = np.transpose(ax_projs,axes=[1,0,2]) # reshape so proj is middle column
-    ax_projs=ax_projs.astype(np.float32)
-    ay_projs = np.transpose(ay_projs,axes=[1,0,2]) # reshape so proj is middle column
-    ay_projs=ay_projs.astype(np.float32)
-    az_projs = np.transpose(az_projs,axes=[1,0,2]) # reshape so proj is middle column
-    az_projs=az_projs.astype(np.float32)
+        for A, projs in ((AX,ax_projs),(AY,ay_projs),(AZ,az_projs)):
+            # reorient to match phase_projs: flipud(proj.T) is a flipped, transposed view
+            proj_view = projs[::-1,i,:].T if reorient == True else projs[:,i,:]
+            
+            #rotate A and project
+            project_along_z(rotate_bulk(A,ax,ay,az),mesh_params=mesh_params,out=proj_view)
     
-    return np.array(ax_projs),np.array(ay_projs),np.array(az_projs)
+    return ax_projs,ay_projs,az_projs
 
 
 def calculate_A_contributions(angles):
@@ -2572,39 +2950,19 @@ def calculate_A_contributions(angles):
     calculate the weighting that the x,y,z components of A will contribute
     to each phase image in the series """
     
-    ws = []
+    # The rotated x,y,z axes are the columns of each rotation matrix, so how
+    # aligned they are with the beam [0,0,1] (i.e. how much each component
+    # contributes to the phase image) is just the bottom row
+    ws = rotation_matrices(angles)[:,2,:].copy()
     
-    for i, a in enumerate(angles):
-        # calculate rotation matrix
-        mrot = rotation_matrix(a[0],a[1],a[2])
-
-        # Calculate position of x,y,z axes after rotation
-        nx = np.dot(mrot,[1,0,0])
-        ny = np.dot(mrot,[0,1,0])
-        nz = np.dot(mrot,[0,0,1])
-        
-        #print(nx)
-
-        # calculate how aligned the new x,y,z axes are with the beam direction
-        # i.e. how much does this component contribute to the phase image?
-        nx = np.dot(nx,[0,0,1])
-        ny = np.dot(ny,[0,0,1])
-        nz = np.dot(nz,[0,0,1])
-        
-        ws.append([nx,ny,nz])
-    return np.array(ws)
+    return ws
 
 def weight_phases(projs,ws):
     """ For a specific projection component, and its set of weights,
     multiplies those weights through the projection data 
     # checked and this definitely returns new_ps in same orientation as phase_proj """
-    new_ps = []
-    for i,w in enumerate(ws):
-        p = projs[:,i,:]
-        new_p = p*w
-        new_ps.append(new_p)
-        
-    new_ps = np.transpose(new_ps,axes=[1,0,2]) # reshape so proj is middle column
+    # proj is the middle column, so broadcast the weights along it
+    new_ps = projs*np.asarray(ws).reshape(1,-1,1)
     
     return new_ps
 
@@ -2613,14 +2971,21 @@ def update_weighted_proj_data(phase_projs,a_weighted_x,a_weighted_y,a_weighted_z
         returns a new set projection data for each component, which is the raw data after removing
         the contribution of the other 2 components and reweighting it back to unity """
     const = -np.pi/constants.codata.value('mag. flux quantum')/(2*np.pi)
-    new_x = phase_projs*1/const - weight_phases(a_weighted_y,ws[:,1]) - weight_phases(a_weighted_z,ws[:,2])
-    new_x = weight_phases(new_x,1/ws[:,0])
+    
+    # weights broadcast along the tilt (middle) axis; the scaled data and each
+    # weighted component are computed once and shared between the three updates
+    wx, wy, wz = (ws[:,i][None,:,None] for i in range(3))
+    base = phase_projs/const
+    ax_w, ay_w, az_w = a_weighted_x*wx, a_weighted_y*wy, a_weighted_z*wz
+    
+    new_x = base - ay_w - az_w
+    new_x *= 1/wx
 
-    new_y = phase_projs*1/const - weight_phases(a_weighted_x,ws[:,0]) - weight_phases(a_weighted_z,ws[:,2])
-    new_y = weight_phases(new_y,1/ws[:,1])
+    new_y = base - ax_w - az_w
+    new_y *= 1/wy
 
-    new_z = phase_projs*1/const - weight_phases(a_weighted_y,ws[:,1]) - weight_phases(a_weighted_x,ws[:,0])
-    new_z = weight_phases(new_z,1/ws[:,2])
+    new_z = base - ay_w - ax_w
+    new_z *= 1/wz
     
     return new_x,new_y,new_z
 
@@ -2636,17 +3001,11 @@ def recon_step(a_projs,ws,angles,mesh_params, thresh=0.706, algorithm = 'SIRT3D_
     # Initialise parameters
     p1,p2,nn=mesh_params
     res=p2[0]/nn[0]
-    a_thresh = []
-    angles_thresh = []
-    
-    # Threshold out data with low weighting
-    for i,w in enumerate(ws):
-        if abs(w) > thresh:
-            a_thresh.append(a_projs[:,i,:])
-            angles_thresh.append(angles[i])
-            
-    angles_thresh=np.array(angles_thresh)
-    a_thresh = np.transpose(a_thresh,axes=[1,0,2]) # reshape so proj is middle column  
+    
+    # Threshold out data with low weighting (proj is middle column)
+    keep = np.abs(ws) > thresh
+    a_thresh = a_projs[:,keep,:]
+    angles_thresh = np.asarray(angles)[keep]
 
     # Perform SIRT reconstruction on remaining data
     vecs = generate_vectors(angles_thresh)
@@ -2825,30 +3184,20 @@ def spatial_freq_filter(ps, rad=10):
     """ Takes a stack of images (indexed in middle column)
     and applys a circular cutoff in Fourier space at a radius
     defined in pixels by rad """
+    ps = np.asarray(ps,dtype=np.float32) # FFTs in complex64
     
-    num = np.shape(ps)[1]
+    # the mask is the same for every image, so build it once
+    h, w = np.shape(ps)[0], np.shape(ps)[2]
+    cent = h/2
+    I, J = np.ogrid[:h, :w]
+    mask = ((cent-I)**2 + (cent-J)**2 < rad**2).astype('uint8')
     
-    ps_filt = []
-    for ipic in range(num):
-        im = ps[:,ipic,:]
-        ft = np.fft.fftshift(np.fft.fft2(im))
-
-        mask = np.zeros_like(ft,dtype='uint8')
-        cent = np.shape(mask)[0]/2
-        for i, mi in enumerate(mask):
-            for j, mij in enumerate(mi):
-                x = cent - i
-                y = cent - j
-                if x**2 + y**2 < rad**2:
-                    mask[i,j] = 1
-
-        ftfilt = mask*ft
-        imfilt = np.real(np.fft.ifft2(np.fft.fftshift(ftfilt)))
-        
-        ps_filt.append(imfilt)
-        
-    ps_filt = np.transpose(ps_filt,axes=[1,0,2]) # reshape so proj is middle column
-    ps_filt=ps_filt.astype(np.float32)
+    # filter every image in one batched FFT over the image axes (0,2),
+    # so the output is already in [x, i, y] order
+    ft = spfft.fftshift(spfft.fft2(ps,axes=(0,2),workers=-1),axes=(0,2))
+    ft *= mask[:,None,:]
+    ps_filt = spfft.ifft2(spfft.fftshift(ft,axes=(0,2)),axes=(0,2),workers=-1,overwrite_x=True)
+    ps_filt = ps_filt.real.astype(np.float32)
 
     return ps_filt
 
@@ -2857,47 +3206,18 @@ def misalign_func(ps,maxshift=1):
     and randomly translates them up/down and left/right by 
     up to a maximum of maxshift pixels """
     
-    num = np.shape(ps)[1]
+    h, num, w = np.shape(ps)
     
-    ps_shift = []
-    for ipic in range(num):
-        im = ps[:,ipic,:]
-        imshift = copy.deepcopy(im)
-
-        xtrans = np.random.randint(-1,high=2)
-        if xtrans!=0:
-            if xtrans == 1:
-
-                val = np.random.choice(list(range(1,maxshift+1,1)))
-                imshift = imshift[val:]
-                imshift = np.pad(imshift,((0,val),(0,0)),mode='edge')
-                #print('right',val)
-            if xtrans == -1:
-
-                val = np.random.choice(list(range(1,maxshift+1,1)))
-                imshift = imshift[:-val]
-                imshift = np.pad(imshift,((val,0),(0,0)),mode='edge')
-                #print('left',val)
-
-        ytrans = np.random.randint(-1,high=2)       
-        if ytrans!=0:
-            if ytrans == 1:
-
-                val = np.random.choice(list(range(1,maxshift+1,1)))
-                imshift = imshift[:,val:]
-                imshift = np.pad(imshift,((0,0),(0,val)),mode='edge')
-                #print('up',val)
-            if ytrans == -1:
-
-                val = np.random.choice(list(range(1,maxshift+1,1)))
-                imshift = imshift[:,:-val]
-                imshift = np.pad(imshift,((0,0),(val,0)),mode='edge')
-                #print('down',val)
-                
-        ps_shift.append(imshift)
+    # random direction (-1,0,1) and size (1 to maxshift) of every image's shift
+    xshift = np.random.randint(-1,high=2,size=num)*np.random.randint(1,maxshift+1,size=num)
+    yshift = np.random.randint(-1,high=2,size=num)*np.random.randint(1,maxshift+1,size=num)
     
-    ps_shift = np.transpose(ps_shift,axes=[1,0,2]) # reshape so proj is middle column
-    ps_shift=ps_shift.astype(np.float32)
+    # edge-padded shift of every image at once: pixel i of image n
+    # takes the value at i+shift[n], clipped to the image edges
+    rows = np.clip(np.arange(h)[:,None] + xshift[None,:], 0, h-1)
+    cols = np.clip(np.arange(w)[None,:] + yshift[:,None], 0, w-1)
+    ps_shift = np.asarray(ps)[rows[:,:,None], np.arange(num)[None,:,None], cols[None,:,:]]
+    ps_shift = ps_shift.astype(np.float32)
     
     return ps_shift
 
@@ -2962,7 +3282,7 @@ def create_circular_mask(imsize, center=(None), radius=None):
     Y, X = np.ogrid[:h, :w]
     dist_from_center = np.sqrt((X - center[0])**2 + (Y-center[1])**2)
     
-    mask = np.ones((h,w))
+    mask = np.ones((h,w),dtype=np.float32)
     mask[dist_from_center >= radius] = 0
     #mask = dist_from_center <= radius
     
@@ -2974,8 +3294,7 @@ def create_circular_mask(imsize, center=(None), radius=None):
 
 
 def apply_circular_mask(circ_mask,im_ft):
-    masked_im = im_ft.copy()
-    masked_im = masked_im*circ_mask
+    masked_im = im_ft*circ_mask # new array, no copy needed first
     #masked_im[~circ_mask] = 0
     return masked_im
 
@@ -2990,31 +3309,52 @@ def centre_sideband(masked_im,fxc,fyc,rc):
 
 def extract_wf_and_phase(ob,ref):
 
-    extracted_ob = np.fft.ifft2(ob)
-    extracted_ref = np.fft.ifft2(ref)
+    extracted_ob = spfft.ifft2(ob,workers=-1)
+    extracted_ref = spfft.ifft2(ref,workers=-1)
 
     psi_0 = extracted_ob / extracted_ref
     phase = np.arctan2(np.imag(psi_0),np.real(psi_0)) # or np.angle(psi_0)
 
     return psi_0, phase
 
-def reconstruct_hologram(holo,ref,fxc=135, fyc = 125,rc = 8,plot=False):
+@lru_cache(maxsize=8)
+def _hamming2d(size):
+    """ 2D Hamming window for a size x size image, cached so a series of
+    holograms of the same size shares one (read-only) window """
+    ham1d = np.hamming(size)
+    ham2d = (np.outer(ham1d,ham1d))**1 # 0.5 normalises but might not remove cross
+    ham2d = ham2d.astype(np.float32)
+    ham2d.flags.writeable = False
+    return ham2d
+
+def reconstruct_hologram(holo,ref,fxc=135, fyc = 125,rc = 8,plot=False,unwrap=True):
+    """ Phase from a hologram and its reference 
+    unwrap = True/False to always/never unwrap the phase, or 'auto' to unwrap only
+             if the wrapped phase has any jump > pi between neighbouring pixels """
     ## hamming filter
     # create window
     size = np.shape(holo)[0]
-    ham1d = np.hamming(size)
-    ham2d = (np.outer(ham1d,ham1d))**1 # 0.5 normalises but might not remove cross
+    ham2d = _hamming2d(size)
 
-    # apply window
-    ob = ham2d*holo
-    ref = ham2d*ref
+    # apply window (single precision, so the FFTs run in complex64)
+    ob = ham2d*np.asarray(holo,dtype=np.float32)
+    ref = ham2d*np.asarray(ref,dtype=np.float32)
     
     ## FT
-    ob_ft = np.fft.fft2(ob)
+    ob_ft = spfft.fft2(ob,workers=-1,overwrite_x=True)
     ob_ft = np.fft.fftshift(ob_ft)
-    ref_ft = np.fft.fft2(ref)
+    ref_ft = spfft.fft2(ref,workers=-1,overwrite_x=True)
     ref_ft = np.fft.fftshift(ref_ft)
     
+    return _phase_from_hologram_ft(ob_ft,ref_ft,fxc=fxc,fyc=fyc,rc=rc,plot=plot,unwrap=unwrap)
+
+def _phase_from_hologram_ft(ob_ft,ref_ft,fxc=135, fyc = 125,rc = 8,plot=False,down=1,unwrap=True):
+    """ Second half of reconstruct_hologram: sideband selection, centring and phase
+    extraction from the (windowed, fftshifted) object and reference FTs 
+    down > 1 keeps only the central 1/down of the centred sideband spectrum, so the
+    phase comes out downsampled by that factor (a Fourier crop rather than a zoom) """
+    size = np.shape(ob_ft)[0]
+    
     ## select sideband
     circ_mask = create_circular_mask(size,center=[fxc,fyc],radius=rc)
     
@@ -3022,9 +3362,7 @@ def reconstruct_hologram(holo,ref,fxc=135, fyc = 125,rc = 8,plot=False):
     masked_ref = apply_circular_mask(circ_mask,ref_ft)
     
     # auto-find centre
-    maxval = np.amax(masked_ob)
-    maxind = np.where(masked_ob == maxval)
-    fxc,fyc = maxind[1][0], maxind[0][0]
+    fyc,fxc = np.unravel_index(np.argmax(masked_ob),np.shape(masked_ob)) # first maximum, one pass
 
 
     # auto-find radius
@@ -3046,19 +3384,38 @@ def reconstruct_hologram(holo,ref,fxc=135, fyc = 125,rc = 8,plot=False):
     centred_ob = centre_sideband(masked_ob,fxc,fyc,int(rc))
     centred_ref = centre_sideband(masked_ref,fxc,fyc,int(rc))
     
+    if down > 1:
+        # low frequency block only, so the inverse FFT and unwrap run at the coarse size
+        n_low = int(round(size/down))
+        lo = size//2 - n_low//2
+        centred_ob = centred_ob[lo:lo+n_low,lo:lo+n_low]
+        centred_ref = centred_ref[lo:lo+n_low,lo:lo+n_low]
+    
     ## reconstruct wave function
     psi_0, phase = extract_wf_and_phase(centred_ob,centred_ref)
     
     ## unwrap phase
-    pu = unwrap_phase(phase)
+    if unwrap == 'auto':
+        # no neighbour jumps > pi (Itoh) means there is nothing to unwrap
+        unwrap = np.abs(np.diff(phase,axis=0)).max() > np.pi or np.abs(np.diff(phase,axis=1)).max() > np.pi
+    pu = unwrap_phase(phase) if unwrap else phase
     #pu = (pu+abs(np.min(pu))) 
     
     return pu
     
 
-def hologram_noise(ps,MX,MY,MZ,mesh_params,angles,n_pad=30,v=1,n=None,c=1000,fxc=400,fyc=400,rc=50,plot=False,fringe=10,up=10):
+def hologram_noise(ps,MX,MY,MZ,mesh_params,angles,n_pad=30,v=1,n=None,c=1000,fxc=400,fyc=400,rc=50,plot=False,fringe=10,up=10,
+                   fourier_down=False):
     """ Add realistic hologram-type noise to a phase image 
     
+    MX,MY,MZ,mesh_params,angles,n_pad are ignored (the amplitude estimate that used them
+    was never applied) and are kept only so existing calls still work
+    
+    fourier_down = True downsamples by cropping the sideband spectrum rather than zooming the
+                   unwrapped phase, so the inverse FFT and unwrapping run at the original size.
+                   The crop samples every up-th upsampled pixel, so on this path the phase is
+                   upsampled with input pixel j at j*up (zoom spaces them by (N*up-1)/(N-1))
+    
     Fringe spacing - Needs to be min 4 pix per fringe, avg camera is 2k. Input dim of 40x40, upscale by 10 so 400x400
                      if 4 for 2k = 4 for 400, should become
     
@@ -3072,41 +3429,53 @@ def hologram_noise(ps,MX,MY,MZ,mesh_params,angles,n_pad=30,v=1,n=None,c=1000,fxc
         holo = noise_scale * np.random.poisson(holo / noise_scale)
     
     """
+    ps = np.asarray(ps,dtype=np.float32)
     num = np.shape(ps)[1]
     
-    ps_n = []
-    
+    # Create holograms (hologram_frame is 2D only, so one image at a time)
+    # Without shot noise the reference is the same for every image, so make it once
     for ipic in range(num):
-        im = ps[:,ipic,:]
-        phase_m = copy.deepcopy(im)
-    
         # Upsample
-        phase_tot = zoom(phase_m,(up,up))
-
-        # estimate amplitude
-        a=angles[ipic]
-        MXr,MYr,MZr=rotate_magnetisation(MX,MY,MZ,a[0],a[1],a[2])
-        mag =(MXr**2+MYr**2+MZr**2)**.5 # magnitude of magnetisation
-        mag = mag/np.max(mag) # rescale so 1 is max
-        thickness = project_along_z(mag,mesh_params=mesh_params) # project
-        thickness = np.pad(thickness,[(n_pad,n_pad),(n_pad,n_pad)],mode='edge')
-        amp = 1-thickness/np.max(thickness)/2
-        amp = zoom(amp,(up,up))
-
-        # Create hologram and reference
+        if fourier_down:
+            # input pixel j -> j*up, to line up with the every up-th pixel of the Fourier crop
+            phase_tot = ndimage.affine_transform(ps[:,ipic,:],(1/up,1/up),output_shape=tuple(up*np.array(np.shape(ps[:,ipic,:]))),
+                                                 mode='nearest')
+        else:
+            phase_tot = zoom(ps[:,ipic,:],(up,up))
+        
         holo = hologram_frame(np.ones_like(phase_tot), phase_tot,sampling=fringe,visibility=v,poisson_noise=n,counts=c)
-        ref = hologram_frame(np.ones_like(phase_tot), np.zeros_like(phase_tot),sampling=fringe,visibility=v,poisson_noise=n)
-
-        # Extract phase
-        pu = reconstruct_hologram(holo,ref,fxc=fxc,fyc=fyc,rc=rc,plot=False)
+        if ipic == 0:
+            # Hamming windowed holograms and references go straight into the FFT input stacks
+            # (single precision, so the FFTs and sideband processing run in complex64)
+            ham2d = _hamming2d(np.shape(holo)[0])
+            holos = np.empty((num,)+np.shape(holo),dtype=np.float32)
+            refs = np.empty((num if n is not None else 1,)+np.shape(holo),dtype=np.float32)
+        np.multiply(holo,ham2d,out=holos[ipic])
+        if n is not None or ipic == 0:
+            ref = hologram_frame(np.ones_like(phase_tot), np.zeros_like(phase_tot),sampling=fringe,visibility=v,poisson_noise=n)
+            np.multiply(ref,ham2d,out=refs[ipic if n is not None else 0])
+    
+    # FT every hologram and reference in one batched FFT each
+    ob_fts, ref_fts = (np.fft.fftshift(spfft.fft2(stack,axes=(-2,-1),workers=-1,overwrite_x=True),axes=(-2,-1))
+                       for stack in (holos,refs))
+    
+    for ipic in range(num):
+        # Extract phase (sideband position is found per image)
+        # a phase range over 2pi must wrap, otherwise only unwrap if the result actually wraps
+        unwrap = True if np.ptp(ps[:,ipic,:]) >= 2*np.pi else 'auto'
+        if fourier_down:
+            phase_recon = _phase_from_hologram_ft(ob_fts[ipic],ref_fts[ipic if n is not None else 0],fxc=fxc,fyc=fyc,rc=rc,
+                                                  plot=False,down=up,unwrap=unwrap)
+        else:
+            pu = _phase_from_hologram_ft(ob_fts[ipic],ref_fts[ipic if n is not None else 0],fxc=fxc,fyc=fyc,rc=rc,plot=False,
+                                         unwrap=unwrap)
 
-        # Downsample
-        phase_recon = zoom(pu,(1/up,1/up))
+            # Downsample
+            phase_recon = zoom(pu,(1/up,1/up))
         
-        ps_n.append(phase_recon)
-        
-    ps_n = np.transpose(ps_n,axes=[1,0,2]) # reshape so proj is middle column
-    ps_n=ps_n.astype(np.float32)
+        if ipic == 0:
+            ps_n = np.empty((np.shape(phase_recon)[0],num,np.shape(phase_recon)[1]),dtype=np.float32)
+        ps_n[:,ipic,:] = phase_recon # proj is middle column
     
     return ps_n
 
@@ -3126,17 +3495,16 @@ def check_holo_params(im,MX,MY,MZ,mesh_params,a=(0,0,0),n_pad=30,fxc=400,fyc=400
     ref_hol = hologram_frame(np.ones_like(phase_tot), np.zeros_like(phase_tot),sampling=fringe,visibility=v,poisson_noise=n)
     
     size = np.shape(holo)[0]
-    ham1d = np.hamming(size)
-    ham2d = (np.outer(ham1d,ham1d))**1 # 0.5 normalises but might not remove cross
+    ham2d = _hamming2d(size)
 
     # apply window
     ob = ham2d*holo
     ref = ham2d*ref_hol
     
     ## FT
-    ob_ft = np.fft.fft2(ob)
+    ob_ft = spfft.fft2(ob,workers=-1,overwrite_x=True)
     ob_ft = np.fft.fftshift(ob_ft)
-    ref_ft = np.fft.fft2(ref)
+    ref_ft = spfft.fft2(ref,workers=-1,overwrite_x=True)
     ref_ft = np.fft.fftshift(ref_ft)
     
     # auto-find radius
@@ -3158,9 +3526,7 @@ def check_holo_params(im,MX,MY,MZ,mesh_params,a=(0,0,0),n_pad=30,fxc=400,fyc=400
     masked_ref = apply_circular_mask(circ_mask,ref_ft)
     
     # auto-find centre
-    maxval = np.amax(masked_ob)
-    maxind = np.where(masked_ob == maxval)
-    fxc,fyc = maxind[1][0], maxind[0][0]
+    fyc,fxc = np.unravel_index(np.argmax(masked_ob),np.shape(masked_ob)) # first maximum, one pass
 
     # remask
     circ_mask = create_circular_mask(size,center=[fxc,fyc],radius=rc)
@@ -3178,8 +3544,7 @@ def check_holo_params(im,MX,MY,MZ,mesh_params,a=(0,0,0),n_pad=30,fxc=400,fyc=400
     
     axs[1,0].imshow(im)
     
-    ps = [im,im]
-    ps = np.transpose(ps,axes=[1,0,2])
+    ps = np.stack([im,im],axis=1)
     
     recon = hologram_noise(ps,MX,MY,MZ,mesh_params,[a,a],fxc=fxc,fyc=fyc,rc=rc,n=n,v=v,c=c,plot=False,fringe=fringe)
     recon = recon[:,0,:]
@@ -3198,9 +3563,11 @@ def check_holo_params(im,MX,MY,MZ,mesh_params,a=(0,0,0),n_pad=30,fxc=400,fyc=400
     axs[1,1].set_title('Output phase',fontsize=14)
     axs[1,2].set_title('Absolute difference',fontsize=14)
     
-def generate_A_projection_fast(AX,AY,AZ,angles,mesh_params=None,unpad=False,reorient = True):
+def generate_A_projection_fast(AX,AY,AZ,angles,mesh_params=None,unpad=False,reorient = True,gpu=False):
     """ Returns A projections for given angles
-    in order [x, i_tilt, y], using astra forward projector """
+    in order [x, i_tilt, y], using astra forward projector 
+    gpu = True links cupy buffers to astra (GPULink) so the volume and sinogram stay
+    on the device; AX, AY, AZ may then be cupy arrays and cupy arrays are returned """
     
     # Define some astra-specific things
     # Fairly sure that these ones in mm don't matter for parallel geom
@@ -3213,53 +3580,54 @@ def generate_A_projection_fast(AX,AY,AZ,angles,mesh_params=None,unpad=False,reor
     # Create astra vectors to describe angles
     vecs = generate_vectors(angles)
 
-    # AX
-        # Create volume geometry
+    # Create volume and projection geometry, shared by all three components
     vol_geom = astra.creators.create_vol_geom(detector_cols, detector_cols,
                                               detector_rows)
+    proj_geom = astra.create_proj_geom('parallel3d_vec', detector_rows, detector_cols, 
+                                       np.array(vecs),(distance_source_origin + distance_origin_detector) /detector_pixel_size, 0)
     
-        # Reorient to match with old version
-    AX = np.transpose(AX,[2,1,0])
-    AX = AX[:,::-1,:]
+    # One volume, one sinogram and one forward projector, reused for AX, AY, AZ
+    if gpu:
+        # device buffers in astra's (slices,rows,cols) layout, linked without copies
+        vol_gpu = cp.empty((detector_rows,detector_cols,detector_cols),dtype=cp.float32)
+        sino_gpu = cp.empty((detector_rows,len(vecs),detector_cols),dtype=cp.float32)
+        link = lambda a: astra.data3d.GPULink(a.data.ptr,a.shape[2],a.shape[1],a.shape[0],a.shape[2]*4)
+        phantom_id = astra.data3d.link('-vol', vol_geom, link(vol_gpu))
+        projections_id = astra.data3d.link('-sino', proj_geom, link(sino_gpu))
+    else:
+        phantom_id = astra.data3d.create('-vol', vol_geom, data=0)
+        projections_id = astra.data3d.create('-sino', proj_geom, data=0)
+    cfg = astra.astra_dict('FP3D_CUDA')
+    cfg['VolumeDataId'] = phantom_id
+    cfg['ProjectionDataId'] = projections_id
+    alg_id = astra.algorithm.create(cfg)
     
-        # Load data into astra
-    phantom_idx = astra.data3d.create('-vol', vol_geom, data=AX)
+    # Scale correctly in line with previous version
+    scale = mesh_params[1][0]/mesh_params[2][0]
     
-        # Create projection geometry
-    proj_geom = astra.create_proj_geom('parallel3d_vec', detector_rows, detector_cols, 
-                                       np.array(vecs),(distance_source_origin + distance_origin_detector) /detector_pixel_size, 0)
+    projs = []
+    for A in (AX,AY,AZ):
+        # Reorient to match with old version, then overwrite the volume data in place
+        if gpu:
+            vol_gpu[...] = cp.asarray(A).transpose(2,1,0)[:,::-1,:]
+        else:
+            A = np.transpose(A,[2,1,0])
+            A = A[:,::-1,:]
+            astra.data3d.store(phantom_id, A)
         
         # Get forward projections
-    projections_idx, projectionsx = astra.creators.create_sino3d_gpu(phantom_idx, proj_geom, vol_geom)
+        astra.algorithm.run(alg_id)
+        if gpu:
+            projs.append(sino_gpu*scale)
+        else:
+            projs.append(astra.data3d.get(projections_id)*scale)
     
-        # Clear astra memory
+    # Clear astra memory
     astra.clear()
     
-    # AY
-    vol_geom = astra.creators.create_vol_geom(detector_cols, detector_cols,
-                                              detector_rows)
-    AY = np.transpose(AY,[2,1,0])
-    AY = AY[:,::-1,:]
-    phantom_idy = astra.data3d.create('-vol', vol_geom, data=AY)
-    proj_geom = astra.create_proj_geom('parallel3d_vec', detector_rows, detector_cols, 
-                                       np.array(vecs),(distance_source_origin + distance_origin_detector) /detector_pixel_size, 0)
-    projections_idy, projectionsy = astra.creators.create_sino3d_gpu(phantom_idy, proj_geom, vol_geom)
-    astra.clear()
-    
-    # AZ
-    vol_geom = astra.creators.create_vol_geom(detector_cols, detector_cols,
-                                              detector_rows)
-    AZ = np.transpose(AZ,[2,1,0])
-    AZ = AZ[:,::-1,:]
-    phantom_idz = astra.data3d.create('-vol', vol_geom, data=AZ)
-    proj_geom = astra.create_proj_geom('parallel3d_vec', detector_rows, detector_cols, 
-                                       np.array(vecs),(distance_source_origin + distance_origin_detector) /detector_pixel_size, 0)
-    projections_idz, projectionsz = astra.creators.create_sino3d_gpu(phantom_idz, proj_geom, vol_geom)
-    astra.clear()
+    ax_projs, ay_projs, az_projs = projs
     
-    # Scale correctly in line with previous version
-    ax_projs = projectionsx*mesh_params[1][0]/mesh_params[2][0]
-    ay_projs = projectionsy*mesh_params[1][0]/mesh_params[2][0]
-    az_projs = projectionsz*mesh_params[1][0]/mesh_params[2][0]
+    if gpu:
+        return ax_projs,ay_projs,az_projs
     
     return np.array(ax_projs),np.array(ay_projs),np.array(az_projs)
\ No newline at end of file